@@ -1,9 +1,15 @@
 from fastapi import HTTPException, Header
 from typing import Optional
-import os
+import hmac
+import time
+
+from cachetools import TTLCache
 
 from app.config import settings
 
+# 已驗證 API Key 的快取（key -> 驗證時間），命中時略過比對
+_KEY_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
 
 async def verify_api_key(
     x_api_key: Optional[str] = Header(None, alias="X-API-Key")
@@ -21,7 +27,10 @@ async def verify_api_key(
             }
         )
     
-    if x_api_key != settings.api_key:
+    if x_api_key in _KEY_CACHE:
+        return x_api_key
+    
+    if not hmac.compare_digest(x_api_key.encode(), settings.api_key.encode()):
         raise HTTPException(
             status_code=401,
             detail={
@@ -30,16 +39,25 @@ async def verify_api_key(
             }
         )
     
+    _KEY_CACHE[x_api_key] = time.monotonic()
     return x_api_key
 
 
+def invalidate_api_key(key: Optional[str] = None):
+    """使已快取的 API Key 失效（輪替金鑰時呼叫，未指定則全部清除）"""
+    if key is None:
+        _KEY_CACHE.clear()
+    else:
+        _KEY_CACHE.pop(key, None)
+
+
 def validate_file_extension(filename: Optional[str]) -> bool:
     """驗證檔案副檔名"""
     if not filename:
         return False
     
-    extension = os.path.splitext(filename)[1].lower().lstrip('.')
-    return extension in settings.allowed_extensions
+    stem, _, extension = filename.rpartition('.')
+    return bool(stem) and extension.lower() in settings.allowed_extensions_set
 
 
 def validate_file_size(file_size: int) -> bool:
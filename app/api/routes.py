@@ -1,11 +1,13 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, BackgroundTasks, Form
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from typing import List, Optional
+import asyncio
 import uuid
 import os
 import logging
-import json
-from datetime import datetime
+import orjson
+from datetime import datetime, timezone
+from pydantic import ValidationError
 
 from app.config import settings
 from app.models.schemas import (
@@ -13,16 +15,30 @@ from app.models.schemas import (
     SystemStatus, PresetConfig, ErrorResponse
 )
 from app.api.dependencies import verify_api_key, validate_file_extension
-from app.services.file_handler import FileHandler
+from app.services.file_handler import FileHandler, FileTooLargeError, get_file_handler
 from app.services.gpu_resource_manager import get_gpu_manager
 from app.services.monitoring import get_monitoring_service
+from app.services.system_sampler import get_system_sampler
+from app.services.task_store import TaskRecord, TaskStore, TaskStoreFullError, get_task_store
 from app.tasks.processing import process_image_task
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-# 暫時的任務儲存（實際應使用資料庫）
-tasks_db = {}
+# 熱路徑使用的設定值，啟動時綁定為模組常數（設定變更後需呼叫 reload_hot_constants）
+_MAX_UPLOAD = settings.max_upload_size
+_RESULT_URL_PREFIX = f"{settings.api_prefix}/result/"
+_USE_CELERY = settings.task_queue_backend == "celery"
+_ACCEL_REDIRECT_PREFIX = settings.accel_redirect_prefix.rstrip("/") + "/" if settings.accel_redirect_prefix else None
+
+
+def reload_hot_constants():
+    """重新綁定熱路徑使用的設定值"""
+    global _MAX_UPLOAD, _RESULT_URL_PREFIX, _USE_CELERY, _ACCEL_REDIRECT_PREFIX
+    _MAX_UPLOAD = settings.max_upload_size
+    _RESULT_URL_PREFIX = f"{settings.api_prefix}/result/"
+    _USE_CELERY = settings.task_queue_backend == "celery"
+    _ACCEL_REDIRECT_PREFIX = settings.accel_redirect_prefix.rstrip("/") + "/" if settings.accel_redirect_prefix else None
 
 
 @router.post("/process", response_model=TaskResponse)
@@ -30,7 +46,9 @@ async def process_image(
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     request: Optional[str] = Form(default="{}"),
-    api_key: Optional[str] = Depends(verify_api_key)
+    api_key: Optional[str] = Depends(verify_api_key),
+    file_handler: FileHandler = Depends(get_file_handler),
+    task_store: TaskStore = Depends(get_task_store)
 ):
     """
     上傳圖片並開始處理
@@ -38,20 +56,19 @@ async def process_image(
     - **file**: 要處理的圖片檔案 (JPEG/PNG)
     - **request**: 處理參數的 JSON 字符串（可選）
     """
-    # 解析 JSON 參數
+    # 解析並驗證 JSON 參數（由 pydantic-core 一次完成）
     try:
-        request_data = json.loads(request) if request else {}
-        process_request = ProcessRequest(**request_data)
-    except json.JSONDecodeError:
-        raise HTTPException(
-            status_code=400,
-            detail=ErrorResponse(
-                error="invalid_json",
-                message="請求參數必須是有效的 JSON 格式",
-                detail={"received": request}
-            ).model_dump()
-        )
-    except Exception as e:
+        process_request = ProcessRequest.model_validate_json(request or "{}")
+    except ValidationError as e:
+        if e.errors()[0]["type"] == "json_invalid":
+            raise HTTPException(
+                status_code=400,
+                detail=ErrorResponse(
+                    error="invalid_json",
+                    message="請求參數必須是有效的 JSON 格式",
+                    detail={"received": request}
+                ).model_dump()
+            )
         raise HTTPException(
             status_code=400,
             detail=ErrorResponse(
@@ -72,33 +89,6 @@ async def process_image(
             ).model_dump()
         )
     
-    # 檢查檔案大小（串流方式，避免記憶體炸彈）
-    file_size = 0
-    chunk_size = 8192  # 8KB chunks
-    
-    # 重置檔案指標到開頭
-    await file.seek(0)
-    
-    # 串流讀取檔案並計算大小
-    while True:
-        chunk = await file.read(chunk_size)
-        if not chunk:
-            break
-        file_size += len(chunk)
-        # 提早檢查大小限制，避免繼續讀取大檔案
-        if file_size > settings.max_upload_size:
-            raise HTTPException(
-                status_code=400,
-                detail=ErrorResponse(
-                    error="file_too_large",
-                    message=f"檔案大小超過限制 ({settings.max_upload_size / 1024 / 1024:.1f} MB)",
-                    detail={"file_size": file_size}
-                ).model_dump()
-            )
-    
-    # 重置檔案指標到開頭，供後續使用
-    await file.seek(0)
-    
     # 檢查是否可以處理新任務（併發限制和 GPU 資源）
     gpu_manager = await get_gpu_manager()
     can_process = await gpu_manager.can_process_task()
@@ -114,12 +104,22 @@ async def process_image(
         )
     
     # 生成任務 ID
-    task_id = str(uuid.uuid4())
+    task_id = uuid.uuid4().hex
     
-    # 儲存檔案
-    file_handler = FileHandler()
+    # 串流儲存檔案，同時檢查大小限制（避免記憶體炸彈）
     try:
-        file_path = await file_handler.save_upload(file, task_id)
+        file_path, file_size = await file_handler.save_upload(
+            file, task_id, max_size=_MAX_UPLOAD
+        )
+    except FileTooLargeError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=ErrorResponse(
+                error="file_too_large",
+                message=f"檔案大小超過限制 ({_MAX_UPLOAD / 1024 / 1024:.1f} MB)",
+                detail={"file_size": e.size}
+            ).model_dump()
+        )
     except Exception as e:
         logger.error(f"儲存檔案失敗: {e}")
         raise HTTPException(
@@ -132,46 +132,67 @@ async def process_image(
         )
     
     # 建立任務記錄
-    task = {
-        "task_id": task_id,
-        "status": "pending",
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
-        "progress": 0,
-        "message": "任務已建立，等待處理",
-        "parameters": process_request.parameters,
-        "file_path": file_path,
-        "webhook_url": process_request.webhook_url,
-        "retry_count": 0,
-        "max_retries": 3,
-        "retry_history": []
-    }
-    tasks_db[task_id] = task
-    
-    # 加入背景任務（暫時使用 FastAPI 的 BackgroundTasks，之後改用 Celery）
-    background_tasks.add_task(
-        process_image_task,
+    now = datetime.now(timezone.utc)
+    task = TaskRecord(
         task_id=task_id,
-        file_path=file_path,
+        status="pending",
+        created_at=now,
+        updated_at=now,
+        message="任務已建立，等待處理",
         parameters=process_request.parameters.model_dump(),
-        tasks_db=tasks_db
+        file_path=file_path,
+        file_size=file_size,
+        webhook_url=process_request.webhook_url
     )
+    try:
+        await task_store.create(task)
+    except TaskStoreFullError as e:
+        # 任務表被等待中與處理中的任務佔滿，拒絕新任務而不是淘汰執行中的任務
+        logger.warning(f"拒絕新任務: {e}")
+        await file_handler.cleanup_task_files(task_id)
+        raise HTTPException(
+            status_code=503,
+            detail=ErrorResponse(
+                error="service_busy",
+                message="服務器繁忙: 進行中的任務過多",
+                detail={"task_id": task_id}
+            ).model_dump()
+        )
+    
+    # 派送處理任務：Celery 模式交由 GPU worker，否則在本程序背景執行
+    task_kwargs = {
+        "task_id": task_id,
+        "file_path": file_path,
+        "parameters": task.parameters
+    }
+    if _USE_CELERY:
+        from app.tasks.celery_app import process_image_celery_task
+        
+        # apply_async 會同步連線 broker，移到執行緒避免阻塞事件循環
+        await asyncio.to_thread(
+            process_image_celery_task.apply_async,
+            kwargs=task_kwargs,
+            queue="gpu"
+        )
+    else:
+        background_tasks.add_task(process_image_task, **task_kwargs)
     
     return TaskResponse(
         task_id=task_id,
         status="pending",
-        created_at=task["created_at"],
-        updated_at=task["updated_at"]
+        created_at=task.created_at,
+        updated_at=task.updated_at
     )
 
 
 @router.get("/task/{task_id}", response_model=TaskDetail)
 async def get_task_status(
     task_id: str,
-    api_key: Optional[str] = Depends(verify_api_key)
+    api_key: Optional[str] = Depends(verify_api_key),
+    task_store: TaskStore = Depends(get_task_store)
 ):
     """查詢任務狀態"""
-    task = tasks_db.get(task_id)
+    task = await task_store.get(task_id)
     if not task:
         raise HTTPException(
             status_code=404,
@@ -183,26 +204,27 @@ async def get_task_status(
         )
     
     return TaskDetail(
-        task_id=task["task_id"],
-        status=task["status"],
-        created_at=task["created_at"],
-        updated_at=task["updated_at"],
-        progress=task.get("progress", 0),
-        message=task.get("message"),
-        result_url=f"{settings.api_prefix}/result/{task_id}" if task.get("result_path") else None,
-        error_message=task.get("error_message"),
-        parameters=task.get("parameters"),
-        metadata=task.get("metadata")
+        task_id=task.task_id,
+        status=task.status,
+        created_at=task.created_at,
+        updated_at=task.updated_at,
+        progress=task.progress,
+        message=task.message,
+        result_url=_RESULT_URL_PREFIX + task_id if task.result_path else None,
+        error_message=task.error_message,
+        parameters=task.parameters,
+        metadata=task.metadata
     )
 
 
 @router.get("/result/{task_id}")
 async def download_result(
     task_id: str,
-    api_key: Optional[str] = Depends(verify_api_key)
+    api_key: Optional[str] = Depends(verify_api_key),
+    task_store: TaskStore = Depends(get_task_store)
 ):
     """下載處理結果"""
-    task = tasks_db.get(task_id)
+    task = await task_store.get(task_id)
     if not task:
         raise HTTPException(
             status_code=404,
@@ -213,18 +235,21 @@ async def download_result(
             ).model_dump()
         )
     
-    if task["status"] != "completed":
+    if task.status != "completed":
         raise HTTPException(
             status_code=400,
             detail=ErrorResponse(
                 error="task_not_completed",
                 message="任務尚未完成",
-                detail={"status": task["status"]}
+                detail={"status": task.status}
             ).model_dump()
         )
     
-    result_path = task.get("result_path")
-    if not result_path or not os.path.exists(result_path):
+    # 優先使用完成時記錄的旗標；舊記錄才需檢查檔案（網路檔案系統可能很慢，移至執行緒）
+    result_path = task.result_path
+    if not result_path or not (
+        task.result_exists or await asyncio.to_thread(os.path.exists, result_path)
+    ):
         raise HTTPException(
             status_code=404,
             detail=ErrorResponse(
@@ -235,49 +260,57 @@ async def download_result(
         )
     
     # 根據輸出格式設定 MIME 類型
-    parameters = task.get("parameters")
-    if parameters and hasattr(parameters, 'output_format'):
-        output_format = parameters.output_format
-    else:
-        output_format = "mp4"
+    output_format = task.parameters.get("output_format", "mp4")
     media_type = {
         "mp4": "video/mp4",
         "webm": "video/webm",
         "gif": "image/gif"
     }.get(output_format, "application/octet-stream")
     
-    return FileResponse(
+    filename = f"depthflow_{task_id}.{output_format}"
+    
+    # 位於 nginx 後方時，交由 nginx 以 sendfile 直接傳送檔案，應用程式不需讀取內容
+    if _ACCEL_REDIRECT_PREFIX:
+        return Response(
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": _ACCEL_REDIRECT_PREFIX + os.path.basename(result_path),
+                "Content-Disposition": f'attachment; filename="{filename}"'
+            }
+        )
+    
+    response = FileResponse(
         path=result_path,
         media_type=media_type,
-        filename=f"depthflow_{task_id}.{output_format}"
+        filename=filename
     )
+    response.headers["X-Accel-Buffering"] = "no"
+    # 影片與 GIF 已是壓縮格式，避免 GZip 中介層重複壓縮
+    response.headers["Content-Encoding"] = "identity"
+    return response
 
 
 @router.get("/status", response_model=SystemStatus)
 async def get_system_status(
-    api_key: Optional[str] = Depends(verify_api_key)
+    api_key: Optional[str] = Depends(verify_api_key),
+    task_store: TaskStore = Depends(get_task_store)
 ):
     """取得系統狀態"""
-    import psutil
-    
-    # 取得系統資訊
-    cpu_percent = psutil.cpu_percent(interval=1)
-    memory = psutil.virtual_memory()
+    # 取得背景取樣的系統資訊（CPU / 記憶體 / GPU）
+    snapshot = await get_system_sampler().get_snapshot()
+    gpu_status = snapshot["gpu_status"]
     
-    # 計算任務統計
-    active_tasks = sum(1 for task in tasks_db.values() if task["status"] == "processing")
-    queue_length = sum(1 for task in tasks_db.values() if task["status"] == "pending")
+    # 取得任務統計
+    queue_length, _ = await task_store.get_counts()
     
-    # 取得 GPU 狀態（使用 GPU 資源管理器）
     gpu_manager = await get_gpu_manager()
-    gpu_status = await gpu_manager.check_gpu_memory()
     gpu_stats = gpu_manager.get_stats()
     
     return SystemStatus(
         gpu_available=gpu_status.get("available", False),
         gpu_memory_used=gpu_status.get("memory_percent", 0),
-        cpu_percent=cpu_percent,
-        memory_percent=memory.percent,
+        cpu_percent=snapshot["cpu_percent"],
+        memory_percent=snapshot["memory_percent"],
         queue_length=queue_length,
         active_tasks=gpu_stats["active_tasks"],
         max_concurrent_tasks=gpu_stats["max_concurrent_tasks"],
@@ -286,13 +319,9 @@ async def get_system_status(
     )
 
 
-@router.get("/presets", response_model=List[PresetConfig])
-async def get_presets(
-    api_key: Optional[str] = Depends(verify_api_key)
-):
-    """取得預設配置列表"""
-    # 預設配置（實際應從資料庫或配置檔案讀取）
-    presets = [
+def _build_presets() -> List[PresetConfig]:
+    """建立預設配置列表（實際應從資料庫或配置檔案讀取）"""
+    return [
         PresetConfig(
             name="快速預覽",
             description="快速生成低解析度預覽",
@@ -330,17 +359,28 @@ async def get_presets(
             is_default=False
         )
     ]
-    
-    return presets
+
+
+# 預設配置為靜態資料，啟動時序列化一次，之後直接回傳位元組
+_PRESETS_JSON = orjson.dumps([preset.model_dump() for preset in _build_presets()])
+
+
+@router.get("/presets", response_model=List[PresetConfig])
+async def get_presets(
+    api_key: Optional[str] = Depends(verify_api_key)
+):
+    """取得預設配置列表"""
+    return Response(_PRESETS_JSON, media_type="application/json")
 
 
 @router.delete("/task/{task_id}")
 async def cancel_task(
     task_id: str,
-    api_key: Optional[str] = Depends(verify_api_key)
+    api_key: Optional[str] = Depends(verify_api_key),
+    task_store: TaskStore = Depends(get_task_store)
 ):
     """取消任務"""
-    task = tasks_db.get(task_id)
+    task = await task_store.get(task_id)
     if not task:
         raise HTTPException(
             status_code=404,
@@ -351,20 +391,29 @@ async def cancel_task(
             ).model_dump()
         )
     
-    if task["status"] in ["completed", "failed", "cancelled"]:
+    if task.status in ["completed", "failed", "cancelled"]:
         raise HTTPException(
             status_code=400,
             detail=ErrorResponse(
                 error="task_not_cancellable",
                 message="任務已經結束，無法取消",
-                detail={"status": task["status"]}
+                detail={"status": task.status}
             ).model_dump()
         )
     
     # 更新任務狀態
-    task["status"] = "cancelled"
-    task["updated_at"] = datetime.utcnow()
-    task["message"] = "任務已取消"
+    if not await task_store.transition(task, task.status, "cancelled", {
+        "message": "任務已取消",
+        "updated_at": datetime.now(timezone.utc)
+    }):
+        raise HTTPException(
+            status_code=409,
+            detail=ErrorResponse(
+                error="task_state_changed",
+                message="任務狀態已變更，請重新查詢",
+                detail={"task_id": task_id}
+            ).model_dump()
+        )
     
     return {"message": "任務已成功取消", "task_id": task_id}
 
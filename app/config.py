@@ -1,7 +1,7 @@
-from pydantic_settings import BaseSettings
-from typing import List
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import List, FrozenSet, Optional
 import os
-from functools import lru_cache
+from functools import lru_cache, cached_property
 
 
 class Settings(BaseSettings):
@@ -14,6 +14,7 @@ class Settings(BaseSettings):
     api_host: str = "0.0.0.0"
     api_port: int = 8080
     api_prefix: str = "/api/v1"
+    workers: int = os.cpu_count() or 1  # 僅在 Redis 任務儲存下生效
     
     # 檔案上傳設定
     max_upload_size: int = 10485760  # 10MB
@@ -22,20 +23,36 @@ class Settings(BaseSettings):
     # 儲存路徑
     upload_path: str = "./storage/uploads"
     output_path: str = "./storage/outputs"
+    # nginx internal location（對應 output_path），設定後下載改由 X-Accel-Redirect 傳送
+    accel_redirect_prefix: Optional[str] = None
     
     # Redis 配置
     redis_host: str = "localhost"
     redis_port: int = 6379
     redis_db: int = 0
     
+    # 任務儲存後端: memory（單一程序）或 redis（多 worker 共享）
+    task_store_backend: str = "memory"
+    task_table_size: int = 10000  # 程序內任務表上限
+    task_retain_hours: int = 24  # 已結束任務的保留時間
+    
     # Celery 配置
     celery_broker_url: str = "redis://localhost:6379/0"
     celery_result_backend: str = "redis://localhost:6379/0"
+    # 任務執行方式: background（API 程序內）或 celery（交由 GPU worker）
+    task_queue_backend: str = "background"
     
     # DepthFlow 設定
     depthflow_max_resolution: int = 2048
     depthflow_default_fps: int = 30
     depthflow_default_duration: int = 3  # 秒
+    depthflow_use_nvenc: bool = True  # GPU 可用時以 NVENC 硬體編碼 MP4
+    
+    # Webhook 設定
+    webhook_batch_enabled: bool = False  # 接收端支援時，同一 URL 短時間內的多個通知合併為 JSON 陣列送出
+    
+    # 監控設定
+    status_sample_interval: float = 1.0  # /status 指標背景取樣間隔（秒）
     
     # 安全設定
     api_key_enabled: bool = False
@@ -47,10 +64,13 @@ class Settings(BaseSettings):
     cors_allow_methods: List[str] = ["*"]
     cors_allow_headers: List[str] = ["*"]
     
-    class Config:
-        env_file = ".env"
-        case_sensitive = False
-        
+    model_config = SettingsConfigDict(env_file=".env", case_sensitive=False)
+    
+    @cached_property
+    def allowed_extensions_set(self) -> FrozenSet[str]:
+        """允許的副檔名集合（小寫，供 O(1) 查詢）"""
+        return frozenset(ext.lower() for ext in self.allowed_extensions)
+    
     def get_redis_url(self) -> str:
         """取得 Redis 連接 URL"""
         return f"redis://{self.redis_host}:{self.redis_port}/{self.redis_db}"
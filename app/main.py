@@ -1,13 +1,22 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from contextlib import asynccontextmanager
+import asyncio
 import logging
-from datetime import datetime
+import time
+
+import orjson
 
 from app.config import settings
 from app.api import routes
 from app.models.schemas import ErrorResponse, HealthResponse
+from app.services.gpu_resource_manager import gpu_memory_janitor_loop
+from app.services.monitoring import metrics_flush_loop
+from app.services.system_sampler import get_system_sampler
+from app.services.task_store import task_eviction_loop
+from app.tasks.webhook_batcher import close_webhook_delivery
+from app.utils.responses import ORJSONResponse
 
 # 設定日誌
 logging.basicConfig(
@@ -23,11 +32,25 @@ async def lifespan(app: FastAPI):
     # 啟動時執行
     logger.info(f"啟動 {settings.app_name} v{settings.app_version}")
     settings.ensure_directories()
+    if settings.debug:
+        # 除錯模式下回報佔用事件循環超過 10ms 的回呼，方便找出未移至執行緒的阻塞 I/O
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = 0.01
+    await get_system_sampler().start()
+    eviction_task = asyncio.create_task(task_eviction_loop())
+    janitor_task = asyncio.create_task(gpu_memory_janitor_loop())
+    metrics_task = asyncio.create_task(metrics_flush_loop())
     
     yield
     
     # 關閉時執行
     logger.info("正在關閉應用程式...")
+    eviction_task.cancel()
+    janitor_task.cancel()
+    metrics_task.cancel()
+    await close_webhook_delivery()
+    await get_system_sampler().stop()
 
 
 # 建立 FastAPI 實例
@@ -38,9 +61,13 @@ app = FastAPI(
     docs_url="/docs",
     redoc_url="/redoc",
     openapi_url="/openapi.json",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
+# 壓縮 JSON 回應（影片/GIF 本身已壓縮，下載端點以 Content-Encoding: identity 略過）
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # 配置 CORS
 app.add_middleware(
     CORSMiddleware,
@@ -56,36 +83,44 @@ app.add_middleware(
 async def global_exception_handler(request: Request, exc: Exception):
     """全域異常處理器"""
     logger.error(f"未處理的異常: {exc}", exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content=ErrorResponse(
             error="internal_server_error",
             message="內部伺服器錯誤",
             detail={"error": str(exc)} if settings.debug else None
-        ).model_dump()
+        )
     )
 
 
+# 健康檢查回應：版本固定於啟動時，時間戳記每秒最多重建一次
+_HEALTH_TMPL = b'{"status":"healthy","version":' + orjson.dumps(settings.app_version) + b',"timestamp":"%s"}'
+_health_body = b""
+_health_second = -1
+
+
+def _health_payload() -> bytes:
+    """取得健康檢查回應內容"""
+    global _health_body, _health_second
+    now = int(time.time())
+    if now != _health_second:
+        _health_body = _HEALTH_TMPL % time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)).encode()
+        _health_second = now
+    return _health_body
+
+
 # 根路徑
 @app.get("/", response_model=HealthResponse)
 async def root():
     """根路徑 - 健康檢查"""
-    return HealthResponse(
-        status="healthy",
-        version=settings.app_version,
-        timestamp=datetime.utcnow()
-    )
+    return Response(_health_payload(), media_type="application/json")
 
 
 # 健康檢查端點
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
     """健康檢查端點"""
-    return HealthResponse(
-        status="healthy",
-        version=settings.app_version,
-        timestamp=datetime.utcnow()
-    )
+    return Response(_health_payload(), media_type="application/json")
 
 
 # 包含 API 路由
@@ -99,10 +134,16 @@ app.include_router(
 if __name__ == "__main__":
     import uvicorn
     
+    # 程序內任務儲存無法跨 worker 共享，僅在 Redis 後端時啟用多 worker
+    workers = settings.workers if settings.task_store_backend == "redis" and not settings.debug else 1
+    
     uvicorn.run(
         "app.main:app",
         host=settings.api_host,
         port=settings.api_port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
         reload=settings.debug,
         log_level="debug" if settings.debug else "info"
     )
\ No newline at end of file
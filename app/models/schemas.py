@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing import Optional, Dict, Any, List
 from enum import Enum
 from datetime import datetime
@@ -29,9 +29,24 @@ class ProcessingParams(BaseModel):
         pattern="^(orbit|zoom|dolly|static)$",
         description="相機運動模式"
     )
+    encoder_preset: str = Field(
+        default="faster",
+        pattern="^(ultrafast|superfast|veryfast|faster|fast|medium|slow|slower|veryslow)$",
+        description="H.264 編碼速度預設（越快 CPU 用量越低，檔案略大）"
+    )
+    quality: str = Field(
+        default="standard",
+        pattern="^(draft|standard|high)$",
+        description="渲染品質（draft/standard 使用 turbo 模式，high 使用高品質模式與 1.5 倍超採樣）"
+    )
+    ssaa: Optional[float] = Field(default=None, ge=1.0, le=2.0, description="超採樣抗鋸齒倍率，未指定時依 quality 決定（1.5 約需 2.25 倍 GPU 運算）")
+    target_bitrate: Optional[int] = Field(default=None, ge=100, le=50000, description="目標位元率（kbps，two_pass 時使用）")
+    two_pass: bool = Field(default=False, description="以兩階段 VBR 編碼到目標位元率（MP4/WebM）")
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        extra="ignore",
+        str_strip_whitespace=True,
+        json_schema_extra={
             "example": {
                 "depth_strength": 1.5,
                 "animation_duration": 3.0,
@@ -41,6 +56,7 @@ class ProcessingParams(BaseModel):
                 "loop": True
             }
         }
+    )
 
 
 class ProcessRequest(BaseModel):
@@ -48,7 +64,10 @@ class ProcessRequest(BaseModel):
     parameters: Optional[ProcessingParams] = Field(default_factory=ProcessingParams)
     webhook_url: Optional[str] = Field(default=None, description="完成時的回調 URL")
     
-    @validator('webhook_url')
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+    
+    @field_validator('webhook_url', mode='after')
+    @classmethod
     def validate_webhook_url(cls, v):
         if v and not v.startswith(('http://', 'https://')):
             raise ValueError('Webhook URL 必須是有效的 HTTP(S) URL')
@@ -62,8 +81,8 @@ class TaskResponse(BaseModel):
     created_at: datetime = Field(..., description="建立時間")
     updated_at: datetime = Field(..., description="更新時間")
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "task_id": "550e8400-e29b-41d4-a716-446655440000",
                 "status": "pending",
@@ -71,6 +90,7 @@ class TaskResponse(BaseModel):
                 "updated_at": "2024-01-16T10:30:00Z"
             }
         }
+    )
 
 
 class TaskDetail(TaskResponse):
@@ -82,8 +102,8 @@ class TaskDetail(TaskResponse):
     parameters: Optional[ProcessingParams] = Field(default=None, description="處理參數")
     metadata: Optional[Dict[str, Any]] = Field(default=None, description="額外中繼資料")
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "task_id": "550e8400-e29b-41d4-a716-446655440000",
                 "status": "completed",
@@ -100,6 +120,7 @@ class TaskDetail(TaskResponse):
                 }
             }
         }
+    )
 
 
 class HealthResponse(BaseModel):
@@ -108,14 +129,15 @@ class HealthResponse(BaseModel):
     version: str = Field(..., description="API 版本")
     timestamp: datetime = Field(..., description="時間戳記")
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "status": "healthy",
                 "version": "1.0.0",
                 "timestamp": "2024-01-16T10:30:00Z"
             }
         }
+    )
 
 
 class SystemStatus(BaseModel):
@@ -130,8 +152,8 @@ class SystemStatus(BaseModel):
     active_tasks: int = Field(..., description="進行中的任務數")
     max_concurrent_tasks: Optional[int] = Field(default=None, description="最大併發任務數")
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "gpu_available": True,
                 "gpu_memory_used": 45.2,
@@ -144,6 +166,7 @@ class SystemStatus(BaseModel):
                 "max_concurrent_tasks": 3
             }
         }
+    )
 
 
 class ErrorResponse(BaseModel):
@@ -152,8 +175,8 @@ class ErrorResponse(BaseModel):
     message: str = Field(..., description="錯誤訊息")
     detail: Optional[Dict[str, Any]] = Field(default=None, description="詳細資訊")
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "error": "validation_error",
                 "message": "檔案格式不支援",
@@ -163,6 +186,7 @@ class ErrorResponse(BaseModel):
                 }
             }
         }
+    )
 
 
 class PresetConfig(BaseModel):
@@ -172,8 +196,8 @@ class PresetConfig(BaseModel):
     parameters: ProcessingParams = Field(..., description="處理參數")
     is_default: bool = Field(default=False, description="是否為預設值")
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "name": "高品質動畫",
                 "description": "適合社群媒體分享的高品質設定",
@@ -186,4 +210,5 @@ class PresetConfig(BaseModel):
                 },
                 "is_default": False
             }
-        }
\ No newline at end of file
+        }
+    )
\ No newline at end of file
@@ -1,32 +1,155 @@
 import logging
 import os
-from typing import Dict, Any, Optional
-import subprocess
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, Any, List, Optional
 import asyncio
-import json
-from PIL import Image
-import numpy as np
-from pathlib import Path
+import time
 
 from app.config import settings
+from app.services.file_handler import load_oriented_image
+from app.services.gpu_resource_manager import get_gpu_manager
+
+if TYPE_CHECKING:
+    import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# 閒置的 DepthScene（依輸出格式分組），跨任務重複使用以保留已載入的深度模型、shader 與 GPU context
+# 同時存在的數量受 GPU 槽位限制，不需另設上限
+_idle_scenes: Dict[str, List[Any]] = defaultdict(list)
+
+# CLI 命令中固定不變的部分，每次只需接上任務相關參數
+_CLI_BASE = ("depthflow", "--backend", "headless")  # 無頭模式
+_CLI_NVENC_ARGS = ("--encoder", "h264_nvenc", "--preset", "p4")
+# 相機運動 -> (CLI 動畫子命令, 強度倍率, 額外參數)
+_CLI_MOVEMENTS = {
+    'orbit': ("circle", 1.0, ()),
+    'zoom': ("zoom", 0.3, ("--loop",)),
+    'dolly': ("dolly", 0.5, ()),
+}
+
+# 渲染品質 -> (turbo 模式, 預設超採樣倍率)
+_QUALITY_PRESETS = {
+    'draft': (True, 1.0),
+    'standard': (True, 1.0),
+    'high': (False, 1.5),
+}
+
+# 記錄子程序輸出時的長度上限（位元組），只保留結尾部分（錯誤訊息通常在最後）
+_MAX_LOG_OUTPUT = 4096
+
+# 兩階段編碼的中間檔會被完整重新編碼，一律以最快的 x264 速度與接近無損的品質渲染
+_INTERMEDIATE_PRESET = "ultrafast"
+_INTERMEDIATE_CRF = 12
+_CLI_INTERMEDIATE_ARGS = ("--preset", _INTERMEDIATE_PRESET, "--crf", str(_INTERMEDIATE_CRF))
+
+# 兩階段編碼使用的 ffmpeg 編碼器參數
+_TWO_PASS_CODECS = {
+    'mp4': ["-c:v", "libx264", "-pix_fmt", "yuv420p"],
+    'webm': ["-c:v", "libvpx-vp9", "-row-mt", "1", "-speed", "4"],
+}
+
+
+async def _remove_file(path: str, label: str) -> bool:
+    """
+    在執行緒中刪除暫存檔；清理失敗只記錄警告，不影響處理結果
+    
+    Args:
+        path: 檔案路徑
+        label: 日誌中的檔案說明
+        
+    Returns:
+        bool: 是否已刪除（檔案不存在或刪除失敗時為 False）
+    """
+    try:
+        await asyncio.to_thread(os.remove, path)
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.warning(f"清理{label}失敗: {e}")
+        return False
+
+
+def _decode_output(data: bytes) -> str:
+    """解碼子程序輸出供日誌使用（截斷過長內容，無效位元組以替代字元表示）"""
+    if len(data) > _MAX_LOG_OUTPUT:
+        return "..." + data[-_MAX_LOG_OUTPUT:].decode('utf-8', 'replace')
+    return data.decode('utf-8', 'replace')
+
 
 class DepthFlowService:
     """DepthFlow 整合服務"""
     
+    # 可用性檢查結果於類別層級共用（每個任務都會建立新的服務實例）
+    _AVAILABILITY_TTL = 300  # 秒
+    _python_api_checked = False
+    _python_api_error: Optional[str] = None
+    _availability_cache: Optional[Dict[str, Any]] = None
+    _availability_checked_at = 0.0
+    
+    # 處理時間估算係數：基準 10 秒（3 秒、30fps、1080p），加上 1.5 倍緩衝
+    _TIME_COEFF = 10.0 * 1.5 / (3.0 * 30.0 * 1080 ** 2)
+    
     def __init__(self):
         self.max_resolution = settings.depthflow_max_resolution
         self.default_fps = settings.depthflow_default_fps
         self.default_duration = settings.depthflow_default_duration
+        self.use_nvenc = settings.depthflow_use_nvenc
+        
+        # Python API 只嘗試導入一次，之後沿用結果直到明確失效
+        if not DepthFlowService._python_api_checked:
+            try:
+                import depthflow
+                DepthFlowService._python_api_error = None
+            except ImportError as e:
+                DepthFlowService._python_api_error = str(e)
+            DepthFlowService._python_api_checked = True
+    
+    @classmethod
+    def invalidate_availability(cls):
+        """清除可用性快取，下次檢查時重新探測"""
+        cls._python_api_checked = False
+        cls._availability_cache = None
+    
+    async def _effective_ssaa(self, parameters: Dict[str, Any]) -> float:
+        """
+        取得實際使用的超採樣倍率：GPU 忙碌或記憶體吃緊時降為 1.0，以降低畫質代替拒絕任務
+        
+        Args:
+            parameters: 處理參數
+            
+        Returns:
+            float: 超採樣倍率
+        """
+        ssaa = parameters.get('ssaa') or _QUALITY_PRESETS[parameters.get('quality', 'standard')][1]
+        if ssaa <= 1.0:
+            return 1.0
+        
+        # 呼叫端已持有槽位並計入 active_tasks，只計算其他任務：其他槽位全被佔用時才降級
+        gpu_manager = await get_gpu_manager()
+        gpu_status = await gpu_manager.check_gpu_memory()
+        other_tasks = gpu_manager.active_tasks - 1
+        if (gpu_status.get('memory_percent', 0) > 70 or
+                other_tasks >= gpu_manager.max_concurrent_tasks - 1):
+            logger.info(f"GPU 負載偏高，超採樣倍率由 {ssaa} 降為 1.0")
+            return 1.0
+        return ssaa
+    
+    async def _should_use_nvenc(self, output_format: str) -> bool:
+        """MP4 輸出且 GPU 可用時改用 NVENC，讓編碼不佔用 CPU（可用性檢查已快取 30 秒）"""
+        if not self.use_nvenc or output_format != 'mp4':
+            return False
+        gpu_manager = await get_gpu_manager()
+        return await gpu_manager.is_gpu_available()
         
     async def process_image(
         self, 
         input_path: str, 
         output_path: str,
         parameters: Dict[str, Any],
-        progress_callback: Optional[callable] = None
+        progress_callback: Optional[callable] = None,
+        image: Optional['np.ndarray'] = None
     ) -> bool:
         """
         使用 DepthFlow 處理圖片
@@ -36,48 +159,26 @@ class DepthFlowService:
             output_path: 輸出檔案路徑
             parameters: 處理參數
             progress_callback: 進度回調函數
+            image: 已解碼的 RGB 影像（可選，提供時不再從檔案解碼）
             
         Returns:
             bool: 是否成功
         """
+        # 兩階段編碼時先渲染到中間檔，再依目標位元率重新編碼到輸出路徑
+        output_format = parameters.get('output_format', 'mp4')
+        two_pass = bool(
+            parameters.get('two_pass', False)
+            and parameters.get('target_bitrate')
+            and output_format in _TWO_PASS_CODECS
+        )
+        if two_pass:
+            # 中間檔固定為 H.264 MP4，最終格式由兩階段編碼決定
+            render_path = f"{os.path.splitext(output_path)[0]}_render.mp4"
+        else:
+            render_path = output_path
+        
+        cli_input_path = input_path
         try:
-            # 處理圖片方向（修復 Portrait 模式旋轉問題）
-            try:
-                from PIL import Image
-                # 開啟圖片並檢查 EXIF 方向
-                with Image.open(input_path) as img:
-                    # 讀取 EXIF 方向資訊
-                    try:
-                        exif = img._getexif()
-                        if exif is not None:
-                            # EXIF Orientation tag = 274 (0x112)
-                            orientation = exif.get(274)
-                            if orientation:
-                                # 根據 EXIF 方向旋轉圖片
-                                rotated = False
-                                if orientation == 3:
-                                    img = img.rotate(180, expand=True)
-                                    rotated = True
-                                elif orientation == 6:
-                                    # Portrait 模式 - 需要旋轉 270 度（順時針）
-                                    img = img.rotate(270, expand=True)
-                                    rotated = True
-                                elif orientation == 8:
-                                    # Portrait 模式（反向）- 需要旋轉 90 度（順時針）
-                                    img = img.rotate(90, expand=True)
-                                    rotated = True
-                                
-                                if rotated:
-                                    # 保存修正後的圖片
-                                    temp_path = input_path.replace('.jpg', '_oriented.jpg').replace('.jpeg', '_oriented.jpeg')
-                                    img.save(temp_path, 'JPEG', quality=95)
-                                    input_path = temp_path  # 使用修正後的圖片
-                                    logger.info(f"圖片方向已修正: EXIF Orientation = {orientation}")
-                    except Exception as e:
-                        logger.warning(f"讀取 EXIF 方向資訊失敗: {e}")
-            except Exception as e:
-                logger.warning(f"圖片方向處理失敗，使用原圖: {e}")
-            
             # 使用 DepthFlow 的 Python API
             try:
                 from depthflow.scene import DepthScene
@@ -87,11 +188,14 @@ class DepthFlowService:
                 if progress_callback:
                     await progress_callback(10, "初始化 DepthFlow")
                 
-                # 建立 DepthScene 實例 (無頭模式)
-                scene = DepthScene(backend="headless")
+                # 取得閒置的 DepthScene，沒有時才建立新的實例 (無頭模式)
+                idle = _idle_scenes[output_format]
+                scene = idle.pop() if idle else DepthScene(backend="headless")
                 
-                # 設定輸入圖片
-                scene.input(image=[input_path])
+                # 設定輸入圖片：優先使用驗證時已解碼並依 EXIF 轉正的影像，避免重複解碼
+                if image is None:
+                    image = await asyncio.to_thread(load_oriented_image, input_path)
+                scene.input(image=[image])
                 
                 # 更新進度
                 if progress_callback:
@@ -129,17 +233,20 @@ class DepthFlowService:
                 # 設定輸出參數
                 fps = parameters.get('fps', self.default_fps)
                 duration = parameters.get('animation_duration', self.default_duration)
-                resolution = parameters.get('resolution')
                 
-                if resolution:
-                    scene.ssaa = 1.5  # 超採樣抗鋸齒
+                # 超採樣抗鋸齒（重複使用的 scene 每次都需重新設定）
+                scene.ssaa = await self._effective_ssaa(parameters)
                 
                 # 設定編碼器
-                output_format = parameters.get('output_format', 'mp4')
-                if output_format == 'mp4':
-                    scene.ffmpeg.h264(preset="fast")
+                if two_pass:
+                    scene.ffmpeg.h264(preset=_INTERMEDIATE_PRESET, crf=_INTERMEDIATE_CRF)
+                elif await self._should_use_nvenc(output_format):
+                    scene.ffmpeg.h264_nvenc(preset="p4", tune="hq", rc="vbr", cq=23)
+                elif output_format == 'mp4':
+                    scene.ffmpeg.h264(preset=parameters.get('encoder_preset', 'faster'))
                 elif output_format == 'webm':
-                    scene.ffmpeg.vp9()
+                    # 啟用多執行緒編碼，速度與品質取得平衡
+                    scene.ffmpeg.vp9(speed=4, row_mt=1, tile_columns=2)
                 
                 # 更新進度
                 if progress_callback:
@@ -147,44 +254,173 @@ class DepthFlowService:
                 
                 # 執行渲染
                 scene.main(
-                    output=output_path,
+                    output=render_path,
                     time=duration,
                     fps=fps,
-                    turbo=False  # 高品質模式
+                    turbo=_QUALITY_PRESETS[parameters.get('quality', 'standard')][0]
                 )
+                # 渲染成功才放回，失敗的 scene 狀態不明確，直接丟棄
+                idle.append(scene)
                 
                 # 更新進度
                 if progress_callback:
                     await progress_callback(90, "動畫生成完成")
                 
-                return True
-                
             except ImportError as e:
                 logger.warning(f"無法導入 DepthFlow Python API: {e}")
-                # 降級到使用 CLI
-                return await self._process_with_cli(input_path, output_path, parameters, progress_callback)
+                # 降級到使用 CLI（CLI 只接受檔案路徑，需先寫出轉正後的圖片）
+                cli_input_path = self._orient_input_file(input_path)
+                if not await self._process_with_cli(
+                    cli_input_path, render_path, parameters, progress_callback, intermediate=two_pass
+                ):
+                    return False
+            
+            if two_pass:
+                return await self._encode_two_pass(
+                    render_path, output_path, output_format, parameters, progress_callback
+                )
+            return True
                 
         except Exception as e:
             logger.error(f"DepthFlow 處理失敗: {e}")
             return False
         finally:
             # 清理暫存的旋轉圖片
-            if '_oriented.jpg' in input_path or '_oriented.jpeg' in input_path:
+            if cli_input_path != input_path and await _remove_file(cli_input_path, "暫存圖片"):
+                logger.info(f"已清理暫存圖片: {cli_input_path}")
+            # 清理兩階段編碼的中間檔
+            if render_path != output_path:
+                await _remove_file(render_path, "中間檔")
+    
+    async def _encode_two_pass(
+        self,
+        source_path: str,
+        output_path: str,
+        output_format: str,
+        parameters: Dict[str, Any],
+        progress_callback: Optional[callable] = None
+    ) -> bool:
+        """
+        以兩階段 VBR 將渲染結果重新編碼到目標位元率
+        
+        Args:
+            source_path: 渲染完成的中間檔路徑
+            output_path: 輸出檔案路徑
+            output_format: 輸出格式（mp4/webm）
+            parameters: 處理參數
+            progress_callback: 進度回調函數
+            
+        Returns:
+            bool: 是否成功
+        """
+        if progress_callback:
+            await progress_callback(92, "兩階段編碼中")
+        
+        target = parameters['target_bitrate']
+        codec = _TWO_PASS_CODECS[output_format]
+        if output_format == 'mp4':
+            codec = codec + ["-preset", parameters.get('encoder_preset', 'faster')]
+        passlog = os.path.splitext(output_path)[0] + "_2pass"
+        base_cmd = ["ffmpeg", "-y", "-i", source_path, *codec, "-b:v", f"{target}k", "-passlogfile", passlog]
+        passes = [
+            base_cmd + ["-pass", "1", "-an", "-f", "null", os.devnull],
+            base_cmd + [
+                "-pass", "2",
+                "-maxrate", f"{target}k",
+                "-minrate", f"{int(target * 0.1)}k",
+                "-bufsize", f"{target * 2}k",
+                output_path
+            ],
+        ]
+        
+        try:
+            for cmd in passes:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                _, stderr = await process.communicate()
+                if process.returncode != 0:
+                    logger.error(f"兩階段編碼失敗 (返回碼: {process.returncode}): {_decode_output(stderr)}")
+                    return False
+            return True
+        except Exception as e:
+            logger.error(f"兩階段編碼失敗: {e}")
+            return False
+        finally:
+            # 清理 ffmpeg 產生的統計檔
+            for suffix in ("-0.log", "-0.log.mbtree"):
+                await _remove_file(passlog + suffix, "兩階段編碼統計檔")
+    
+    def _orient_input_file(self, input_path: str) -> str:
+        """
+        依 EXIF 方向寫出轉正後的暫存圖片（僅供 CLI 使用）
+        
+        Args:
+            input_path: 輸入圖片路徑
+            
+        Returns:
+            str: 轉正後的暫存圖片路徑，不需轉正時為原路徑
+        """
+        # 處理圖片方向（修復 Portrait 模式旋轉問題）
+        try:
+            from PIL import Image
+            # 開啟圖片並檢查 EXIF 方向
+            with Image.open(input_path) as img:
+                # 讀取 EXIF 方向資訊
                 try:
-                    os.remove(input_path)
-                    logger.info(f"已清理暫存圖片: {input_path}")
+                    exif = img._getexif()
+                    if exif is not None:
+                        # EXIF Orientation tag = 274 (0x112)
+                        orientation = exif.get(274)
+                        if orientation:
+                            # 根據 EXIF 方向旋轉圖片
+                            rotated = False
+                            if orientation == 3:
+                                img = img.rotate(180, expand=True)
+                                rotated = True
+                            elif orientation == 6:
+                                # Portrait 模式 - 需要旋轉 270 度（順時針）
+                                img = img.rotate(270, expand=True)
+                                rotated = True
+                            elif orientation == 8:
+                                # Portrait 模式（反向）- 需要旋轉 90 度（順時針）
+                                img = img.rotate(90, expand=True)
+                                rotated = True
+                            
+                            if rotated:
+                                # 保存修正後的圖片
+                                temp_path = input_path.replace('.jpg', '_oriented.jpg').replace('.jpeg', '_oriented.jpeg')
+                                img.save(temp_path, 'JPEG', quality=95)
+                                logger.info(f"圖片方向已修正: EXIF Orientation = {orientation}")
+                                return temp_path  # 使用修正後的圖片
                 except Exception as e:
-                    logger.warning(f"清理暫存圖片失敗: {e}")
+                    logger.warning(f"讀取 EXIF 方向資訊失敗: {e}")
+        except Exception as e:
+            logger.warning(f"圖片方向處理失敗，使用原圖: {e}")
+        return input_path
     
     async def _process_with_cli(
         self, 
         input_path: str, 
         output_path: str, 
         parameters: Dict[str, Any],
-        progress_callback: Optional[callable] = None
+        progress_callback: Optional[callable] = None,
+        intermediate: bool = False
     ) -> bool:
         """
         使用 CLI 處理圖片（降級方案）
+        
+        Args:
+            input_path: 輸入圖片路徑
+            output_path: 輸出檔案路徑
+            parameters: 處理參數
+            progress_callback: 進度回調函數
+            intermediate: 輸出為兩階段編碼的中間檔時為 True，改用快速的中間檔編碼設定
+            
+        Returns:
+            bool: 是否成功
         """
         try:
             # 更新進度
@@ -193,39 +429,40 @@ class DepthFlowService:
             
             # 構建基本命令
             cmd = [
-                "depthflow",
+                *_CLI_BASE,
                 "--image", input_path,
                 "--output", output_path,
-                "--backend", "headless",  # 無頭模式
                 "--time", str(parameters.get('animation_duration', self.default_duration)),
                 "--fps", str(parameters.get('fps', self.default_fps)),
             ]
             
-            # 設定解析度
-            resolution = parameters.get('resolution')
-            if resolution:
-                cmd.extend(["--ssaa", "1.5"])
+            # 設定超採樣抗鋸齒
+            ssaa = await self._effective_ssaa(parameters)
+            if ssaa > 1.0:
+                cmd += ("--ssaa", str(ssaa))
             
-            # 添加動畫類型（基於之前的範例代碼）
-            camera_movement = parameters.get('camera_movement', 'orbit')
-            depth_strength = parameters.get('depth_strength', 1.0)
+            # 設定編碼器：GPU 可用時使用 NVENC，否則指定 libx264 速度（未指定時會使用較慢的 medium）
+            output_format = parameters.get('output_format', 'mp4')
+            if intermediate:
+                cmd += _CLI_INTERMEDIATE_ARGS
+            elif await self._should_use_nvenc(output_format):
+                cmd += _CLI_NVENC_ARGS
+            elif output_format == 'mp4':
+                cmd += ("--preset", parameters.get('encoder_preset', 'faster'))
             
-            # 根據 DepthFlow 的實際 CLI 格式添加動畫參數
-            if camera_movement == 'orbit':
-                cmd.extend(["circle", "--intensity", str(depth_strength)])
-            elif camera_movement == 'zoom':
-                cmd.extend(["zoom", "--intensity", str(depth_strength * 0.3), "--loop"])
-            elif camera_movement == 'dolly':
-                cmd.extend(["dolly", "--intensity", str(depth_strength * 0.5)])
-            else:
-                cmd.extend(["circle", "--intensity", str(depth_strength)])
+            # 根據 DepthFlow 的實際 CLI 格式添加動畫參數（未知的運動模式使用環繞）
+            action, scale, extra = _CLI_MOVEMENTS.get(
+                parameters.get('camera_movement', 'orbit'), _CLI_MOVEMENTS['orbit']
+            )
+            cmd += (action, "--intensity", str(parameters.get('depth_strength', 1.0) * scale), *extra)
             
             # 更新進度
             if progress_callback:
                 await progress_callback(50, "執行 DepthFlow CLI")
             
-            # 執行命令
-            logger.info(f"執行命令: {' '.join(cmd)}")
+            # 執行命令（日誌層級未啟用時不組合命令字串）
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("執行命令: %s", ' '.join(cmd))
             
             process = await asyncio.create_subprocess_exec(
                 *cmd,
@@ -236,14 +473,13 @@ class DepthFlowService:
             stdout, stderr = await process.communicate()
             
             # 記錄詳細輸出
-            if stdout:
-                logger.info(f"CLI stdout: {stdout.decode()}")
-            if stderr:
-                logger.warning(f"CLI stderr: {stderr.decode()}")
+            if stdout and logger.isEnabledFor(logging.INFO):
+                logger.info("CLI stdout: %s", _decode_output(stdout))
+            if stderr and logger.isEnabledFor(logging.WARNING):
+                logger.warning("CLI stderr: %s", _decode_output(stderr))
             
             if process.returncode != 0:
                 logger.error(f"DepthFlow CLI 執行失敗 (返回碼: {process.returncode})")
-                logger.error(f"錯誤輸出: {stderr.decode()}")
                 return False
             
             # 更新進度
@@ -262,40 +498,46 @@ class DepthFlowService:
             logger.error(f"CLI 處理失敗: {e}")
             return False
     
-    def check_depthflow_available(self) -> Dict[str, bool]:
-        """檢查 DepthFlow 是否可用"""
+    async def check_depthflow_available(self) -> Dict[str, Any]:
+        """檢查 DepthFlow 是否可用（結果快取 5 分鐘）"""
+        now = time.monotonic()
+        if (DepthFlowService._availability_cache is not None and
+                now - DepthFlowService._availability_checked_at < self._AVAILABILITY_TTL):
+            return DepthFlowService._availability_cache
+        
+        python_error = DepthFlowService._python_api_error
         result = {
-            "python_api": False,
+            "python_api": python_error is None,
             "cli": False,
             "overall": False,
-            "python_error": None,
+            "python_error": python_error,
             "cli_error": None
         }
-        
-        # 檢查 Python API
-        try:
-            import depthflow
-            result["python_api"] = True
+        if python_error is None:
             logger.info(f"DepthFlow Python API 可用")
-        except ImportError as e:
-            result["python_error"] = str(e)
-            logger.warning(f"DepthFlow Python API 不可用: {e}")
+        else:
+            logger.warning(f"DepthFlow Python API 不可用: {python_error}")
         
         # 檢查 CLI
         try:
-            process = subprocess.run(
-                ["depthflow", "--version"], 
-                capture_output=True, 
-                text=True,
-                timeout=10
+            process = await asyncio.create_subprocess_exec(
+                "depthflow", "--version",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
             )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=10)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise
             result["cli"] = process.returncode == 0
             if result["cli"]:
-                logger.info(f"DepthFlow CLI 可用: {process.stdout.strip()}")
+                logger.info(f"DepthFlow CLI 可用: {stdout.decode().strip()}")
             else:
-                result["cli_error"] = process.stderr.strip()
-                logger.warning(f"DepthFlow CLI 失敗: {process.stderr.strip()}")
-        except subprocess.TimeoutExpired:
+                result["cli_error"] = stderr.decode().strip()
+                logger.warning(f"DepthFlow CLI 失敗: {result['cli_error']}")
+        except asyncio.TimeoutError:
             result["cli_error"] = "CLI 執行超時"
             logger.warning("DepthFlow CLI 執行超時")
         except Exception as e:
@@ -303,9 +545,11 @@ class DepthFlowService:
             logger.warning(f"DepthFlow CLI 執行錯誤: {e}")
         
         result["overall"] = result["python_api"] or result["cli"]
+        DepthFlowService._availability_cache = result
+        DepthFlowService._availability_checked_at = now
         return result
     
-    async def estimate_processing_time(self, parameters: Dict[str, Any]) -> float:
+    def estimate_processing_time(self, parameters: Dict[str, Any]) -> float:
         """
         估算處理時間（秒）
         
@@ -315,23 +559,7 @@ class DepthFlowService:
         Returns:
             float: 估計的處理時間
         """
-        # 基礎時間（秒）
-        base_time = 10.0
-        
-        # 根據動畫時長調整
         duration = parameters.get('animation_duration', self.default_duration)
-        time_factor = duration / 3.0  # 3秒為基準
-        
-        # 根據 FPS 調整
         fps = parameters.get('fps', self.default_fps)
-        fps_factor = fps / 30.0  # 30fps 為基準
-        
-        # 根據解析度調整
-        resolution = parameters.get('resolution', 1080)
-        resolution_factor = (resolution / 1080) ** 2  # 平方關係
-        
-        # 計算總時間
-        estimated_time = base_time * time_factor * fps_factor * resolution_factor
-        
-        # 加入一些緩衝
-        return estimated_time * 1.5
\ No newline at end of file
+        resolution = parameters.get('resolution') or 1080
+        return self._TIME_COEFF * duration * fps * resolution * resolution
@@ -1,58 +1,188 @@
 import os
-import aiofiles
+import asyncio
+import struct
 from fastapi import UploadFile
 import logging
-from typing import Optional
+from functools import lru_cache
+from typing import TYPE_CHECKING, BinaryIO, Optional, Tuple
 from datetime import datetime
 
 from app.config import settings
 
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image
+
 logger = logging.getLogger(__name__)
 
 
+class FileTooLargeError(ValueError):
+    """上傳檔案超過大小限制"""
+    
+    def __init__(self, size: int, max_size: int):
+        super().__init__(f"檔案大小超過限制: {size} > {max_size}")
+        self.size = size
+        self.max_size = max_size
+
+
+# 支援格式的檔案開頭魔術位元組
+_JPEG_MAGIC = b'\xff\xd8\xff'
+_PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+# 讀取的檔頭長度：PNG 簽章 (8) + IHDR 長度與類型 (8) + 寬高 (8)
+_HEAD_SIZE = 24
+
+
+def _read_head(filepath: str) -> bytes:
+    """讀取檔案開頭位元組"""
+    with open(filepath, 'rb') as f:
+        return f.read(_HEAD_SIZE)
+
+
+def _check_image_size(width: int, height: int) -> bool:
+    """檢查圖片尺寸是否在允許範圍內"""
+    if width < 100 or height < 100:
+        logger.warning(f"圖片尺寸過小: {width}x{height}")
+        return False
+    
+    if width > 8192 or height > 8192:
+        logger.warning(f"圖片尺寸過大: {width}x{height}")
+        return False
+    
+    return True
+
+
+def _check_image_header(img: 'Image.Image') -> bool:
+    """依圖片標頭檢查格式與尺寸（不解碼像素）"""
+    if img.format is None or img.format.lower() not in ['jpeg', 'jpg', 'png']:
+        return False
+    
+    return _check_image_size(*img.size)
+
+
+def _validate_image_file(filepath: str) -> bool:
+    """以檔頭判斷格式：PNG 直接從 IHDR 讀出尺寸，JPEG 與檔頭不完整的 PNG 交由 PIL 解析標頭"""
+    head = _read_head(filepath)
+    if head.startswith(_PNG_MAGIC) and len(head) == _HEAD_SIZE and head[12:16] == b'IHDR':
+        return _check_image_size(*struct.unpack('>II', head[16:24]))
+    
+    if head.startswith((_JPEG_MAGIC, _PNG_MAGIC)):
+        from PIL import Image
+        
+        with Image.open(filepath) as img:
+            return _check_image_header(img)
+    
+    logger.warning(f"不支援的圖片格式: {filepath}")
+    return False
+
+
+def _to_oriented_array(img: 'Image.Image') -> 'np.ndarray':
+    """依 EXIF 方向轉正並解碼為 RGB 陣列"""
+    import numpy as np
+    from PIL import ImageOps
+    
+    return np.asarray(ImageOps.exif_transpose(img).convert("RGB"))
+
+
+def load_oriented_image(filepath: str) -> 'np.ndarray':
+    """
+    讀取圖片並依 EXIF 方向轉正
+    
+    Args:
+        filepath: 圖片路徑
+        
+    Returns:
+        np.ndarray: RGB 影像陣列
+    """
+    from PIL import Image
+    
+    with Image.open(filepath) as img:
+        return _to_oriented_array(img)
+
+
 class FileHandler:
     """檔案處理服務"""
     
+    # 串流寫入的區塊大小
+    chunk_size = 1 << 20  # 1MB
+    
     def __init__(self):
         self.upload_path = settings.upload_path
         self.output_path = settings.output_path
+        # 目錄只在建立服務時確認一次；路徑前綴預先組好，產生檔名時只需字串串接
+        self.ensure_directories()
+        self._upload_prefix = os.path.join(self.upload_path, "")
+        self._output_prefix = os.path.join(self.output_path, "")
         
-    async def save_upload(self, file: UploadFile, task_id: str) -> str:
+    async def save_upload(
+        self,
+        file: UploadFile,
+        task_id: str,
+        max_size: Optional[int] = None
+    ) -> Tuple[str, int]:
         """
-        儲存上傳的檔案
+        以串流方式儲存上傳的檔案，不將整個檔案載入記憶體
         
         Args:
             file: 上傳的檔案物件
             task_id: 任務 ID
+            max_size: 檔案大小上限（位元組），超過時中止並刪除已寫入的部分
             
         Returns:
-            str: 儲存的檔案路徑
+            Tuple[str, int]: 儲存的檔案路徑與檔案大小
+            
+        Raises:
+            FileTooLargeError: 檔案超過 max_size
         """
-        # 取得檔案副檔名
-        extension = os.path.splitext(file.filename)[1].lower()
+        # 取得檔案副檔名並生成檔案路徑
+        _, dot, extension = file.filename.rpartition('.')
+        filepath = f"{self._upload_prefix}{task_id}_original{dot}{extension.lower()}"
         
-        # 生成檔案名稱
-        filename = f"{task_id}_original{extension}"
-        filepath = os.path.join(self.upload_path, filename)
-        
-        # 確保目錄存在
-        os.makedirs(self.upload_path, exist_ok=True)
+        # Starlette 已記錄暫存檔大小時，超過上限直接拒絕，不需寫入任何內容
+        if max_size is not None and file.size is not None and file.size > max_size:
+            raise FileTooLargeError(file.size, max_size)
         
+        # 上傳目錄已於建立服務時確認，此處不再逐次檢查
         try:
-            # 非同步寫入檔案
-            async with aiofiles.open(filepath, 'wb') as f:
-                content = await file.read()
-                await f.write(content)
+            # 在單一執行緒內從 SpooledTemporaryFile 複製，避免每個區塊都往返事件循環
+            file_size = await asyncio.to_thread(self._copy_upload, file.file, filepath, max_size)
             
-            logger.info(f"檔案已儲存: {filepath}")
-            return filepath
+            logger.info(f"檔案已儲存: {filepath} ({file_size} bytes)")
+            return filepath, file_size
             
         except Exception as e:
-            logger.error(f"儲存檔案失敗: {e}")
-            # 如果寫入失敗，嘗試刪除部分寫入的檔案
-            if os.path.exists(filepath):
+            if not isinstance(e, FileTooLargeError):
+                logger.error(f"儲存檔案失敗: {e}")
+            raise
+    
+    def _copy_upload(self, src: BinaryIO, filepath: str, max_size: Optional[int]) -> int:
+        """
+        分塊複製上傳內容到目標檔案，同時檢查大小限制
+        
+        Args:
+            src: 上傳檔案的底層檔案物件
+            filepath: 目標檔案路徑
+            max_size: 檔案大小上限（位元組）
+            
+        Returns:
+            int: 寫入的位元組數
+        """
+        src.seek(0)
+        file_size = 0
+        try:
+            with open(filepath, 'wb') as dst:
+                while chunk := src.read(self.chunk_size):
+                    file_size += len(chunk)
+                    if max_size is not None and file_size > max_size:
+                        raise FileTooLargeError(file_size, max_size)
+                    dst.write(chunk)
+        except BaseException:
+            # 寫入失敗時刪除部分寫入的檔案
+            try:
                 os.remove(filepath)
+            except FileNotFoundError:
+                pass
             raise
+        return file_size
     
     def get_output_path(self, task_id: str, format: str) -> str:
         """
@@ -65,50 +195,47 @@ class FileHandler:
         Returns:
             str: 輸出檔案路徑
         """
-        filename = f"{task_id}_output.{format}"
-        return os.path.join(self.output_path, filename)
+        return f"{self._output_prefix}{task_id}_output.{format}"
     
-    def cleanup_task_files(self, task_id: str):
+    async def cleanup_task_files(self, task_id: str):
         """
-        清理任務相關的檔案
+        清理任務相關的檔案（上傳與輸出目錄同時在執行緒中處理）
         
         Args:
             task_id: 任務 ID
         """
-        # 清理上傳的檔案
-        for filename in os.listdir(self.upload_path):
-            if filename.startswith(task_id):
-                filepath = os.path.join(self.upload_path, filename)
-                try:
-                    os.remove(filepath)
-                    logger.info(f"已刪除檔案: {filepath}")
-                except Exception as e:
-                    logger.error(f"刪除檔案失敗: {filepath}, 錯誤: {e}")
-        
-        # 清理輸出檔案
-        for filename in os.listdir(self.output_path):
-            if filename.startswith(task_id):
-                filepath = os.path.join(self.output_path, filename)
-                try:
-                    os.remove(filepath)
-                    logger.info(f"已刪除檔案: {filepath}")
-                except Exception as e:
-                    logger.error(f"刪除檔案失敗: {filepath}, 錯誤: {e}")
-    
-    def get_file_info(self, filepath: str) -> dict:
+        await asyncio.gather(
+            asyncio.to_thread(self._remove_task_files, self.upload_path, task_id),
+            asyncio.to_thread(self._remove_task_files, self.output_path, task_id)
+        )
+    
+    @staticmethod
+    def _remove_task_files(directory: str, task_id: str):
+        """刪除目錄中以任務 ID 開頭的檔案"""
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(task_id):
+                    try:
+                        os.unlink(entry.path)
+                        logger.info(f"已刪除檔案: {entry.path}")
+                    except Exception as e:
+                        logger.error(f"刪除檔案失敗: {entry.path}, 錯誤: {e}")
+    
+    async def get_file_info(self, filepath: str) -> Optional[dict]:
         """
-        取得檔案資訊
+        取得檔案資訊（stat 於執行緒中執行）
         
         Args:
             filepath: 檔案路徑
             
         Returns:
-            dict: 檔案資訊
+            dict: 檔案資訊，檔案不存在時為 None
         """
-        if not os.path.exists(filepath):
+        try:
+            stat = await asyncio.to_thread(os.stat, filepath)
+        except FileNotFoundError:
             return None
         
-        stat = os.stat(filepath)
         return {
             "path": filepath,
             "size": stat.st_size,
@@ -118,7 +245,7 @@ class FileHandler:
     
     async def validate_image(self, filepath: str) -> bool:
         """
-        驗證圖片檔案
+        驗證圖片檔案（只讀取標頭，不解碼像素）
         
         Args:
             filepath: 檔案路徑
@@ -127,32 +254,49 @@ class FileHandler:
             bool: 是否為有效的圖片
         """
         try:
+            return await asyncio.to_thread(_validate_image_file, filepath)
+            
+        except Exception as e:
+            logger.error(f"驗證圖片失敗: {e}")
+            return False
+    
+    async def validate_and_decode(self, filepath: str) -> Tuple[bool, Optional['np.ndarray']]:
+        """
+        驗證圖片並解碼為依 EXIF 轉正的 RGB 陣列，供 DepthFlow 直接使用以避免重複解碼
+        
+        Args:
+            filepath: 檔案路徑
+            
+        Returns:
+            Tuple[bool, Optional[np.ndarray]]: 是否為有效的圖片，以及解碼後的影像
+        """
+        def _validate_and_decode():
+            # 非 JPEG/PNG 的檔案不需經過 PIL 即可拒絕
+            if not _read_head(filepath).startswith((_JPEG_MAGIC, _PNG_MAGIC)):
+                logger.warning(f"不支援的圖片格式: {filepath}")
+                return False, None
+            
             from PIL import Image
             
-            # 嘗試開啟圖片
             with Image.open(filepath) as img:
-                # 檢查圖片格式
-                if img.format.lower() not in ['jpeg', 'jpg', 'png']:
-                    return False
-                
-                # 檢查圖片尺寸
-                width, height = img.size
-                if width < 100 or height < 100:
-                    logger.warning(f"圖片尺寸過小: {width}x{height}")
-                    return False
-                
-                if width > 8192 or height > 8192:
-                    logger.warning(f"圖片尺寸過大: {width}x{height}")
-                    return False
-                
-                return True
-                
+                if not _check_image_header(img):
+                    return False, None
+                return True, _to_oriented_array(img)
+        
+        try:
+            return await asyncio.to_thread(_validate_and_decode)
         except Exception as e:
             logger.error(f"驗證圖片失敗: {e}")
-            return False
+            return False, None
     
     def ensure_directories(self):
         """確保必要的目錄存在"""
         os.makedirs(self.upload_path, exist_ok=True)
         os.makedirs(self.output_path, exist_ok=True)
-        logger.info(f"已確保目錄存在: {self.upload_path}, {self.output_path}")
\ No newline at end of file
+        logger.info(f"已確保目錄存在: {self.upload_path}, {self.output_path}")
+
+
+@lru_cache(maxsize=1)
+def get_file_handler() -> FileHandler:
+    """取得檔案處理服務單例"""
+    return FileHandler()
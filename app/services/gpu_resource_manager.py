@@ -3,11 +3,14 @@ GPU 資源管理器
 處理 GPU 記憶體監控、任務調度和資源限制
 """
 import asyncio
+import atexit
+import heapq
+import itertools
 import logging
+import time
 from contextlib import asynccontextmanager
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from dataclasses import dataclass
-from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
@@ -28,24 +31,100 @@ class GPUResourceManager:
     def __init__(self, max_concurrent_tasks: int = 3, memory_threshold: float = 0.8):
         self.max_concurrent_tasks = max_concurrent_tasks
         self.memory_threshold = memory_threshold
+        # 可用槽位數與等待中的任務；槽位釋出時交給排序值最小的等待者，而非先到先得
+        # active_tasks 只供統計（單執行緒事件循環內不需加鎖）
+        self._free_slots = max_concurrent_tasks
+        self._waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self._waiter_seq = itertools.count()
         self.active_tasks = 0
         self.task_queue = asyncio.Queue()
-        self._lock = asyncio.Lock()
         self._gpu_available = None
         self._last_gpu_check = None
+        # NVML 只初始化一次並保留裝置 handle；總記憶體於第一次查詢時快取
+        self._pynvml = None
+        self._nvml_handle = self._init_nvml()
+        self._memory_total: Optional[int] = None
+        # GPU 狀態快取：短時間內的查詢共用同一次結果
+        self._status_cache: Optional[GPUStatus] = None
+        self._status_checked_at = 0.0
+        self._status_lock = asyncio.Lock()
+    
+    def _init_nvml(self):
+        """初始化 NVML 並取得 GPU 0 的 handle，不可用時回傳 None"""
+        try:
+            import pynvml
+            pynvml.nvmlInit()
+            atexit.register(pynvml.nvmlShutdown)
+            self._pynvml = pynvml
+            return pynvml.nvmlDeviceGetHandleByIndex(0)
+        except ImportError:
+            logger.warning("pynvml 未安裝，無法取得詳細 GPU 狀態")
+        except Exception as e:
+            logger.warning(f"初始化 NVML 失敗: {e}")
+        return None
         
     async def get_gpu_status(self) -> GPUStatus:
-        """取得 GPU 狀態信息"""
+        """取得 GPU 狀態信息（同步的驅動程式查詢移至執行緒，避免阻塞事件循環）"""
+        return await asyncio.to_thread(self._get_gpu_status_sync)
+    
+    async def _get_cached_status(self, ttl: float = 1.0) -> GPUStatus:
+        """
+        取得快取的 GPU 狀態，超過 ttl 秒才重新查詢（並發的查詢只會觸發一次）
+        
+        Args:
+            ttl: 快取有效時間（秒）
+            
+        Returns:
+            GPUStatus: GPU 狀態信息
+        """
+        if self._status_cache is not None and time.monotonic() - self._status_checked_at < ttl:
+            return self._status_cache
+        
+        async with self._status_lock:
+            # 等待鎖期間可能已由其他協程更新
+            if self._status_cache is None or time.monotonic() - self._status_checked_at >= ttl:
+                self._status_cache = await self.get_gpu_status()
+                self._status_checked_at = time.monotonic()
+            return self._status_cache
+    
+    def _get_gpu_status_sync(self) -> GPUStatus:
+        """取得 GPU 狀態信息：優先只用 NVML，不可用時才透過 PyTorch 查詢"""
         status = GPUStatus()
         
+        # NVML 直接向驅動程式查詢，比走訪 PyTorch 快取配置器便宜得多
+        if self._nvml_handle is not None:
+            try:
+                pynvml = self._pynvml
+                handle = self._nvml_handle
+                
+                memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                status.available = True
+                status.memory_total = memory.total
+                status.memory_used = memory.used
+                status.memory_free = memory.free
+                status.memory_percent = (memory.used / memory.total) * 100
+                
+                # 取得溫度
+                status.temperature = pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)
+                
+                # 取得利用率
+                status.utilization = pynvml.nvmlDeviceGetUtilizationRates(handle).gpu
+                return status
+                
+            except Exception as e:
+                logger.warning(f"取得 GPU 狀態時出錯: {e}")
+                status = GPUStatus()
+        
         try:
             import torch
             if torch.cuda.is_available():
                 status.available = True
                 device = torch.cuda.current_device()
                 
-                # 取得記憶體信息
-                memory_total = torch.cuda.get_device_properties(device).total_memory
+                # 取得記憶體信息（總記憶體不會變動，只查詢一次）
+                if self._memory_total is None:
+                    self._memory_total = torch.cuda.get_device_properties(device).total_memory
+                memory_total = self._memory_total
                 memory_allocated = torch.cuda.memory_allocated(device)
                 memory_cached = torch.cuda.memory_reserved(device)
                 
@@ -53,25 +132,6 @@ class GPUResourceManager:
                 status.memory_used = memory_allocated
                 status.memory_free = memory_total - memory_cached
                 status.memory_percent = (memory_cached / memory_total) * 100
-                
-                # 取得 GPU 利用率（需要 nvidia-ml-py）
-                try:
-                    import pynvml
-                    pynvml.nvmlInit()
-                    handle = pynvml.nvmlDeviceGetHandleByIndex(device)
-                    
-                    # 取得溫度
-                    temperature = pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)
-                    status.temperature = temperature
-                    
-                    # 取得利用率
-                    utilization = pynvml.nvmlDeviceGetUtilizationRates(handle)
-                    status.utilization = utilization.gpu
-                    
-                except ImportError:
-                    logger.warning("pynvml 未安裝，無法取得詳細 GPU 狀態")
-                except Exception as e:
-                    logger.warning(f"取得 GPU 狀態時出錯: {e}")
                     
         except ImportError:
             logger.warning("PyTorch 未安裝，GPU 不可用")
@@ -82,12 +142,11 @@ class GPUResourceManager:
     
     async def is_gpu_available(self) -> bool:
         """檢查 GPU 是否可用"""
-        # 快取 GPU 可用性檢查結果 30 秒
-        now = datetime.now()
-        if (self._last_gpu_check is None or 
-            (now - self._last_gpu_check).total_seconds() > 30):
+        # 快取 GPU 可用性檢查結果 30 秒（monotonic 不受系統時間調整影響）
+        now = time.monotonic()
+        if self._last_gpu_check is None or now - self._last_gpu_check > 30.0:
             
-            status = await self.get_gpu_status()
+            status = await self._get_cached_status()
             self._gpu_available = status.available
             self._last_gpu_check = now
             
@@ -95,7 +154,7 @@ class GPUResourceManager:
     
     async def check_gpu_memory(self) -> Dict[str, Any]:
         """檢查 GPU 記憶體狀態"""
-        status = await self.get_gpu_status()
+        status = await self._get_cached_status()
         
         if not status.available:
             return {
@@ -116,65 +175,109 @@ class GPUResourceManager:
             "utilization": status.utilization
         }
     
+    async def _check_gpu_resources(self) -> Dict[str, Any]:
+        """檢查 GPU 是否可用且記憶體充足"""
+        gpu_status = await self.check_gpu_memory()
+        if not gpu_status["available"]:
+            return {
+                "can_process": False,
+                "reason": "GPU 不可用",
+                "gpu_status": gpu_status
+            }
+        
+        if not gpu_status["memory_available"]:
+            return {
+                "can_process": False,
+                "reason": "GPU 記憶體不足",
+                "gpu_status": gpu_status
+            }
+        
+        return {
+            "can_process": True,
+            "active_tasks": self.active_tasks,
+            "gpu_status": gpu_status
+        }
+    
     async def can_process_task(self) -> Dict[str, Any]:
         """檢查是否可以處理新任務"""
-        async with self._lock:
-            # 檢查併發任務限制
-            if self.active_tasks >= self.max_concurrent_tasks:
-                return {
-                    "can_process": False,
-                    "reason": "達到最大併發任務限制",
-                    "active_tasks": self.active_tasks,
-                    "max_tasks": self.max_concurrent_tasks
-                }
-            
-            # 檢查 GPU 狀態
-            gpu_status = await self.check_gpu_memory()
-            if not gpu_status["available"]:
-                return {
-                    "can_process": False,
-                    "reason": "GPU 不可用",
-                    "gpu_status": gpu_status
-                }
-            
-            if not gpu_status["memory_available"]:
-                return {
-                    "can_process": False,
-                    "reason": "GPU 記憶體不足",
-                    "gpu_status": gpu_status
-                }
-            
+        # 檢查併發任務限制
+        if self._free_slots == 0:
             return {
-                "can_process": True,
+                "can_process": False,
+                "reason": "達到最大併發任務限制",
                 "active_tasks": self.active_tasks,
-                "gpu_status": gpu_status
+                "max_tasks": self.max_concurrent_tasks
             }
+        
+        # 檢查 GPU 狀態
+        return await self._check_gpu_resources()
+    
+    async def _wait_for_slot(self, priority: float):
+        """
+        等待槽位：排序值為進入等待的時間加上 priority，預估耗時短的任務優先，
+        但等待夠久的任務終究會排到前面，不會無限期被插隊
+        
+        Args:
+            priority: 任務預估耗時（秒），越小越優先
+        """
+        if self._free_slots > 0 and not self._waiters:
+            self._free_slots -= 1
+            return
+        
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        heapq.heappush(self._waiters, (loop.time() + priority, next(self._waiter_seq), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # 已分配到槽位後才被取消時歸還槽位；尚未分配的等待者在釋出時略過
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()
+            raise
+    
+    def _release_slot(self):
+        """釋出槽位給排序值最小且仍在等待的任務"""
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._free_slots += 1
     
     @asynccontextmanager
-    async def acquire_gpu_slot(self, task_id: str):
-        """取得 GPU 處理槽位"""
-        # 檢查是否可以處理任務
-        check_result = await self.can_process_task()
+    async def acquire_gpu_slot(self, task_id: str, priority: float = 0.0):
+        """
+        取得 GPU 處理槽位（槽位已滿時排隊等待）
+        
+        Args:
+            task_id: 任務 ID
+            priority: 任務預估耗時（秒），排隊時耗時短的任務優先
+        """
+        # GPU 不可用或記憶體不足時直接失敗，交由任務重試機制處理
+        check_result = await self._check_gpu_resources()
         if not check_result["can_process"]:
             error_msg = f"無法取得 GPU 槽位: {check_result['reason']}"
             logger.warning(f"Task {task_id}: {error_msg}")
             raise RuntimeError(error_msg)
         
-        async with self._lock:
-            self.active_tasks += 1
-            logger.info(f"Task {task_id}: 取得 GPU 槽位 ({self.active_tasks}/{self.max_concurrent_tasks})")
-        
+        await self._wait_for_slot(priority)
+        self.active_tasks += 1
+        logger.info(f"Task {task_id}: 取得 GPU 槽位 ({self.active_tasks}/{self.max_concurrent_tasks})")
         try:
-            # 清理 GPU 快取
-            await self.cleanup_gpu_memory()
+            # 不在此清理 GPU 快取：empty_cache 會讓下一個任務重新向驅動程式配置記憶體
             yield
         finally:
-            async with self._lock:
-                self.active_tasks -= 1
-                logger.info(f"Task {task_id}: 釋放 GPU 槽位 ({self.active_tasks}/{self.max_concurrent_tasks})")
+            self.active_tasks -= 1
+            self._release_slot()
+            logger.info(f"Task {task_id}: 釋放 GPU 槽位 ({self.active_tasks}/{self.max_concurrent_tasks})")
     
     async def cleanup_gpu_memory(self):
-        """清理 GPU 記憶體"""
+        """
+        清理 GPU 記憶體
+        
+        empty_cache 會把快取區塊歸還驅動程式，之後的配置都得重新 cudaMalloc，
+        因此只應在閒置或緊急情況下呼叫
+        """
         try:
             import torch
             if torch.cuda.is_available():
@@ -197,6 +300,23 @@ class GPUResourceManager:
         except Exception as e:
             logger.error(f"強制清理 GPU 記憶體時出錯: {e}")
     
+    async def release_idle_memory(self) -> bool:
+        """
+        沒有任務執行且快取超過記憶體閾值時釋放 GPU 快取
+        
+        Returns:
+            bool: 是否執行了清理
+        """
+        if self.active_tasks > 0:
+            return False
+        
+        status = await self._get_cached_status()
+        if not status.available or status.memory_percent / 100 < self.memory_threshold:
+            return False
+        
+        await self.cleanup_gpu_memory()
+        return True
+    
     def get_stats(self) -> Dict[str, Any]:
         """取得統計信息"""
         return {
@@ -211,4 +331,14 @@ gpu_manager = GPUResourceManager()
 
 async def get_gpu_manager() -> GPUResourceManager:
     """取得 GPU 資源管理器實例"""
-    return gpu_manager
\ No newline at end of file
+    return gpu_manager
+
+async def gpu_memory_janitor_loop(interval: float = 300):
+    """定期在閒置時釋放 GPU 快取，取代每個任務開始前的清理"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await gpu_manager.release_idle_memory():
+                logger.info("GPU 閒置，已釋放快取記憶體")
+        except Exception as e:
+            logger.warning(f"釋放 GPU 快取失敗: {e}")
\ No newline at end of file
@@ -4,8 +4,11 @@
 """
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+import os
+import time
+from datetime import datetime
+from enum import IntEnum
+from typing import Dict, List, Set, Any, Optional
 from dataclasses import dataclass, field
 import psutil
 
@@ -13,6 +16,26 @@ from app.services.gpu_resource_manager import get_gpu_manager
 
 logger = logging.getLogger(__name__)
 
+class IssueKind(IntEnum):
+    """健康問題類型"""
+    CPU_HIGH = 1
+    MEMORY_HIGH = 2
+    DISK_LOW = 3
+    GPU_UNAVAILABLE = 4
+    GPU_MEMORY_HIGH = 5
+    GPU_TEMPERATURE_HIGH = 6
+    TASK_STUCK = 7
+
+# 屬於嚴重問題的類型
+_CRITICAL_ISSUES = frozenset({
+    IssueKind.CPU_HIGH,
+    IssueKind.MEMORY_HIGH,
+    IssueKind.DISK_LOW,
+    IssueKind.GPU_UNAVAILABLE,
+    IssueKind.GPU_MEMORY_HIGH,
+    IssueKind.GPU_TEMPERATURE_HIGH,
+})
+
 @dataclass
 class HealthStatus:
     """健康狀態"""
@@ -20,6 +43,8 @@ class HealthStatus:
     overall_status: str = "healthy"  # healthy, warning, critical
     issues: List[str] = field(default_factory=list)
     recommendations: List[str] = field(default_factory=list)
+    # 問題類型於產生問題時標記，判斷狀態與自動恢復時不需比對訊息文字
+    issue_kinds: Set[IssueKind] = field(default_factory=set)
     
     # 系統指標
     cpu_usage: float = 0.0
@@ -32,6 +57,44 @@ class HealthStatus:
     active_tasks: int = 0
     failed_tasks_count: int = 0
     stuck_tasks_count: int = 0
+    
+    def add_issue(self, kind: IssueKind, issue: str, recommendation: str):
+        """
+        新增健康問題
+        
+        Args:
+            kind: 問題類型
+            issue: 問題描述
+            recommendation: 建議處理方式
+        """
+        self.issue_kinds.add(kind)
+        self.issues.append(issue)
+        self.recommendations.append(recommendation)
+
+def _scan_and_delete(directory: str, cutoff: float) -> int:
+    """
+    刪除目錄中最後修改時間早於 cutoff 的檔案（同步執行，應於執行緒中呼叫）
+    
+    Args:
+        directory: 要清理的目錄
+        cutoff: 截止時間（epoch 秒）
+        
+    Returns:
+        int: 刪除的檔案數
+    """
+    removed = 0
+    try:
+        # scandir 的 DirEntry 帶有目錄讀取時取得的資訊，直接比較 epoch 秒數
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+                    logger.debug(f"刪除過期檔案: {entry.path}")
+    except FileNotFoundError:
+        return removed
+    return removed
+
 
 class HealthMonitor:
     """健康監控服務"""
@@ -42,6 +105,22 @@ class HealthMonitor:
         self.cleanup_interval = 600  # 清理間隔（10分鐘）
         self.last_cleanup = datetime.now()
         self.running = False
+        # 停止監控時設定，讓等待中的清理循環立即結束
+        self._stop_event = asyncio.Event()
+        self.disk_check_interval = 60  # 磁碟用量變化緩慢，快取較久（秒）
+        
+        # 最近一次健康檢查結果，check_interval 內的查詢直接沿用
+        self._last_status: Optional[HealthStatus] = None
+        self._last_status_ts = 0.0
+        self._disk_usage = None
+        self._disk_usage_ts = 0.0
+        # GPU 狀態快取，gpu_status_ttl 秒內的檢查沿用同一次查詢
+        self.gpu_status_ttl = 5
+        self._last_gpu_status: Optional[Dict[str, Any]] = None
+        self._last_gpu_status_ts = 0.0
+        
+        # 先呼叫一次以建立基準，之後以 interval=None 讀取兩次呼叫間的平均，不需阻塞等待
+        psutil.cpu_percent(interval=None)
         
     async def start_monitoring(self):
         """啟動健康監控"""
@@ -49,6 +128,7 @@ class HealthMonitor:
             return
             
         self.running = True
+        self._stop_event.clear()
         logger.info("健康監控服務啟動")
         
         # 啟動監控任務
@@ -58,6 +138,7 @@ class HealthMonitor:
     async def stop_monitoring(self):
         """停止健康監控"""
         self.running = False
+        self._stop_event.set()
         logger.info("健康監控服務停止")
     
     async def _monitoring_loop(self):
@@ -73,28 +154,50 @@ class HealthMonitor:
     async def _cleanup_loop(self):
         """清理循環"""
         while self.running:
+            # 直接等待一個清理間隔；停止監控時立即醒來結束
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.cleanup_interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            
             try:
-                if (datetime.now() - self.last_cleanup).total_seconds() > self.cleanup_interval:
-                    await self._perform_cleanup()
-                    self.last_cleanup = datetime.now()
-                await asyncio.sleep(60)  # 每分鐘檢查一次是否需要清理
+                await self._perform_cleanup()
+                self.last_cleanup = datetime.now()
             except Exception as e:
                 logger.error(f"清理循環錯誤: {e}")
-                await asyncio.sleep(60)
     
-    async def _perform_health_check(self):
+    def _get_disk_usage(self):
+        """取得磁碟用量（快取 disk_check_interval 秒）"""
+        now = time.monotonic()
+        if self._disk_usage is None or now - self._disk_usage_ts >= self.disk_check_interval:
+            self._disk_usage = psutil.disk_usage('/')
+            self._disk_usage_ts = now
+        return self._disk_usage
+    
+    async def _get_gpu_status(self) -> Dict[str, Any]:
+        """取得 GPU 狀態（快取 gpu_status_ttl 秒）"""
+        now = time.monotonic()
+        if self._last_gpu_status is None or now - self._last_gpu_status_ts >= self.gpu_status_ttl:
+            gpu_manager = await get_gpu_manager()
+            self._last_gpu_status = await gpu_manager.check_gpu_memory()
+            self._last_gpu_status_ts = now
+        return self._last_gpu_status
+    
+    def _sample_system(self):
+        """取得記憶體與磁碟用量（同步呼叫，於執行緒中一次取得）"""
+        return psutil.virtual_memory(), self._get_disk_usage()
+    
+    async def _perform_health_check(self) -> Optional[HealthStatus]:
         """執行健康檢查"""
         try:
-            # 檢查系統資源
-            cpu_percent = psutil.cpu_percent(interval=1)
-            memory = psutil.virtual_memory()
+            # CPU 使用率的基準依執行緒記錄，需與 __init__ 的基準呼叫同在事件循環執行緒上讀取
+            # （interval=None 不會阻塞）；記憶體與磁碟用量移至執行緒取得
+            cpu_percent = psutil.cpu_percent(interval=None)
+            memory, disk_usage = await asyncio.to_thread(self._sample_system)
             
             # 檢查 GPU 狀態
-            gpu_manager = await get_gpu_manager()
-            gpu_status = await gpu_manager.check_gpu_memory()
-            
-            # 檢查磁碟空間
-            disk_usage = psutil.disk_usage('/')
+            gpu_status = await self._get_gpu_status()
             
             # 創建健康狀態報告
             health_status = HealthStatus(
@@ -120,45 +223,68 @@ class HealthMonitor:
             # 自動恢復
             await self._auto_recovery(health_status)
             
+            self._last_status = health_status
+            self._last_status_ts = time.monotonic()
+            return health_status
+            
         except Exception as e:
             logger.error(f"健康檢查失敗: {e}")
+            return None
     
     async def _check_resource_issues(self, health_status: HealthStatus, cpu_percent: float, memory_percent: float, disk_usage):
         """檢查資源問題"""
         # CPU 使用率過高
         if cpu_percent > 90:
-            health_status.issues.append(f"CPU 使用率過高: {cpu_percent:.1f}%")
-            health_status.recommendations.append("考慮增加 CPU 資源或優化程式碼")
+            health_status.add_issue(
+                IssueKind.CPU_HIGH,
+                f"CPU 使用率過高: {cpu_percent:.1f}%",
+                "考慮增加 CPU 資源或優化程式碼"
+            )
         
         # 記憶體使用率過高
         if memory_percent > 85:
-            health_status.issues.append(f"記憶體使用率過高: {memory_percent:.1f}%")
-            health_status.recommendations.append("考慮增加記憶體或優化記憶體使用")
+            health_status.add_issue(
+                IssueKind.MEMORY_HIGH,
+                f"記憶體使用率過高: {memory_percent:.1f}%",
+                "考慮增加記憶體或優化記憶體使用"
+            )
         
         # 磁碟空間不足
         disk_percent = (disk_usage.used / disk_usage.total) * 100
         if disk_percent > 90:
-            health_status.issues.append(f"磁碟空間不足: {disk_percent:.1f}%")
-            health_status.recommendations.append("清理磁碟空間或增加儲存容量")
+            health_status.add_issue(
+                IssueKind.DISK_LOW,
+                f"磁碟空間不足: {disk_percent:.1f}%",
+                "清理磁碟空間或增加儲存容量"
+            )
     
     async def _check_gpu_issues(self, health_status: HealthStatus, gpu_status: Dict):
         """檢查 GPU 問題"""
         if not gpu_status.get("available", False):
-            health_status.issues.append("GPU 不可用")
-            health_status.recommendations.append("檢查 GPU 驅動程式和 CUDA 安裝")
+            health_status.add_issue(
+                IssueKind.GPU_UNAVAILABLE,
+                "GPU 不可用",
+                "檢查 GPU 驅動程式和 CUDA 安裝"
+            )
             return
         
         # GPU 記憶體使用率過高
         gpu_memory_percent = gpu_status.get("memory_percent", 0)
         if gpu_memory_percent > 90:
-            health_status.issues.append(f"GPU 記憶體使用率過高: {gpu_memory_percent:.1f}%")
-            health_status.recommendations.append("清理 GPU 記憶體或減少併發任務")
+            health_status.add_issue(
+                IssueKind.GPU_MEMORY_HIGH,
+                f"GPU 記憶體使用率過高: {gpu_memory_percent:.1f}%",
+                "清理 GPU 記憶體或減少併發任務"
+            )
         
         # GPU 溫度過高
         gpu_temperature = gpu_status.get("temperature")
         if gpu_temperature and gpu_temperature > 85:
-            health_status.issues.append(f"GPU 溫度過高: {gpu_temperature:.1f}°C")
-            health_status.recommendations.append("檢查 GPU 散熱或減少工作負載")
+            health_status.add_issue(
+                IssueKind.GPU_TEMPERATURE_HIGH,
+                f"GPU 溫度過高: {gpu_temperature:.1f}°C",
+                "檢查 GPU 散熱或減少工作負載"
+            )
     
     async def _check_task_issues(self, health_status: HealthStatus):
         """檢查任務問題"""
@@ -174,22 +300,10 @@ class HealthMonitor:
     
     def _determine_overall_status(self, health_status: HealthStatus):
         """決定整體健康狀態"""
-        critical_keywords = ["不可用", "不足", "過高"]
-        warning_keywords = ["警告", "注意"]
-        
-        has_critical = any(
-            any(keyword in issue for keyword in critical_keywords)
-            for issue in health_status.issues
-        )
-        
-        has_warning = any(
-            any(keyword in issue for keyword in warning_keywords)
-            for issue in health_status.issues
-        )
-        
-        if has_critical:
+        # 依問題類型判斷，非嚴重的問題一律視為 warning
+        if not health_status.issue_kinds.isdisjoint(_CRITICAL_ISSUES):
             health_status.overall_status = "critical"
-        elif has_warning or health_status.issues:
+        elif health_status.issues:
             health_status.overall_status = "warning"
         else:
             health_status.overall_status = "healthy"
@@ -198,11 +312,11 @@ class HealthMonitor:
         """自動恢復機制"""
         try:
             # GPU 記憶體清理
-            if any("GPU 記憶體" in issue for issue in health_status.issues):
+            if IssueKind.GPU_MEMORY_HIGH in health_status.issue_kinds:
                 await self._cleanup_gpu_memory()
             
             # 清理過期任務
-            if any("任務" in issue for issue in health_status.issues):
+            if IssueKind.TASK_STUCK in health_status.issue_kinds:
                 await self._cleanup_stuck_tasks()
             
         except Exception as e:
@@ -231,14 +345,16 @@ class HealthMonitor:
         try:
             logger.info("執行定期清理")
             
-            # 清理臨時檔案
-            await self._cleanup_temp_files()
-            
-            # 清理 GPU 記憶體
-            await self._cleanup_gpu_memory()
-            
-            # 清理過期任務
-            await self._cleanup_expired_tasks()
+            # 臨時檔案、GPU 記憶體與過期任務的清理互不相依，同時執行
+            results = await asyncio.gather(
+                self._cleanup_temp_files(),
+                self._cleanup_gpu_memory(),
+                self._cleanup_expired_tasks(),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"定期清理項目失敗: {result}")
             
         except Exception as e:
             logger.error(f"定期清理失敗: {e}")
@@ -246,33 +362,15 @@ class HealthMonitor:
     async def _cleanup_temp_files(self):
         """清理臨時檔案"""
         try:
-            import os
-            import glob
-            from pathlib import Path
+            # 清理上傳目錄中 24 小時前的檔案
+            now = time.time()
+            removed = await asyncio.to_thread(_scan_and_delete, "storage/uploads", now - 24 * 3600)
             
-            # 清理上傳目錄中的過期檔案
-            uploads_dir = Path("storage/uploads")
-            if uploads_dir.exists():
-                # 刪除 24 小時前的檔案
-                cutoff_time = datetime.now() - timedelta(hours=24)
-                for file_path in uploads_dir.glob("*"):
-                    if file_path.is_file():
-                        file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
-                        if file_mtime < cutoff_time:
-                            file_path.unlink()
-                            logger.debug(f"刪除過期檔案: {file_path}")
+            # 清理輸出目錄中 48 小時前的檔案
+            removed += await asyncio.to_thread(_scan_and_delete, "storage/outputs", now - 48 * 3600)
             
-            # 清理輸出目錄中的過期檔案
-            outputs_dir = Path("storage/outputs")
-            if outputs_dir.exists():
-                # 刪除 48 小時前的檔案
-                cutoff_time = datetime.now() - timedelta(hours=48)
-                for file_path in outputs_dir.glob("*"):
-                    if file_path.is_file():
-                        file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
-                        if file_mtime < cutoff_time:
-                            file_path.unlink()
-                            logger.debug(f"刪除過期結果檔案: {file_path}")
+            if removed:
+                logger.info(f"已刪除 {removed} 個過期檔案")
             
         except Exception as e:
             logger.error(f"清理臨時檔案失敗: {e}")
@@ -287,38 +385,28 @@ class HealthMonitor:
             logger.error(f"清理過期任務失敗: {e}")
     
     async def get_health_status(self) -> HealthStatus:
-        """取得目前健康狀態"""
-        # 執行即時健康檢查
-        await self._perform_health_check()
-        
-        # 返回當前狀態（簡化版本）
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
+        """取得目前健康狀態（check_interval 內沿用最近一次檢查結果）"""
+        if (self._last_status is not None and
+                time.monotonic() - self._last_status_ts < self.check_interval):
+            return self._last_status
         
-        gpu_manager = await get_gpu_manager()
-        gpu_status = await gpu_manager.check_gpu_memory()
-        
-        return HealthStatus(
-            cpu_usage=cpu_percent,
-            memory_usage=memory.percent,
-            gpu_available=gpu_status.get("available", False),
-            gpu_memory_usage=gpu_status.get("memory_percent", 0),
-            gpu_temperature=gpu_status.get("temperature")
-        )
+        # 執行即時健康檢查
+        status = await self._perform_health_check()
+        return status if status is not None else HealthStatus(overall_status="critical", issues=["健康檢查失敗"])
 
 # 全域健康監控器實例
 health_monitor = HealthMonitor()
 
-async def get_health_monitor() -> HealthMonitor:
+def get_health_monitor() -> HealthMonitor:
     """取得健康監控器實例"""
     return health_monitor
 
 async def start_health_monitoring():
     """啟動健康監控"""
-    monitor = await get_health_monitor()
+    monitor = get_health_monitor()
     await monitor.start_monitoring()
 
 async def stop_health_monitoring():
     """停止健康監控"""
-    monitor = await get_health_monitor()
+    monitor = get_health_monitor()
     await monitor.stop_monitoring()
\ No newline at end of file
@@ -2,25 +2,21 @@
 監控和錯誤追蹤服務
 收集系統性能指標、錯誤統計和事件日誌
 """
+import asyncio
+import inspect
 import logging
+import sys
 import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional
 from collections import defaultdict, deque
-from dataclasses import dataclass, field
+from itertools import islice
+from dataclasses import asdict, dataclass, field
 from functools import wraps
 import traceback
 
 logger = logging.getLogger(__name__)
 
-@dataclass
-class MetricsData:
-    """指標數據"""
-    timestamp: datetime
-    metric_name: str
-    value: float
-    tags: Dict[str, str] = field(default_factory=dict)
-
 @dataclass
 class ErrorEvent:
     """錯誤事件"""
@@ -28,64 +24,121 @@ class ErrorEvent:
     error_type: str
     error_message: str
     task_id: Optional[str] = None
-    stack_trace: Optional[str] = None
     context: Dict[str, Any] = field(default_factory=dict)
+    # 只記錄呼叫堆疊的檔名與行號（不保留 frame，也不讀原始碼），需要時才格式化
+    _raw_tb: Optional[traceback.StackSummary] = field(default=None, repr=False)
+    
+    @property
+    def stack_trace(self) -> Optional[str]:
+        """格式化後的堆疊追蹤"""
+        if self._raw_tb is None:
+            return None
+        return "".join(self._raw_tb.format())
+
+@dataclass(slots=True)
+class TaskStats:
+    """任務統計"""
+    total_tasks: int = 0
+    completed_tasks: int = 0
+    failed_tasks: int = 0
+    retried_tasks: int = 0
+    average_processing_time: float = 0.0
 
 class MonitoringService:
     """監控服務"""
     
+    # 待處理指標超過此數量時由呼叫端直接套用，避免沒有背景迴圈時無限累積
+    max_pending_metrics = 4096
+    # 每批套用的指標數上限
+    metrics_batch_size = 256
+    # 錯誤率統計的時間視窗（秒），以每秒一個桶計數
+    error_rate_window = 300
+    # 錯誤類型統計的種類上限，超過後新類型一律計入 "other"，避免字典無限成長
+    max_error_types = 256
+    
     def __init__(self, max_metrics_history: int = 1000, max_error_history: int = 500):
         self.max_metrics_history = max_metrics_history
         self.max_error_history = max_error_history
         
-        # 指標儲存
-        self.metrics_history: deque = deque(maxlen=max_metrics_history)
+        # 待處理的指標 (時間, 名稱, 數值, 標籤)；deque 的 append/popleft 可跨執行緒安全使用
+        self._pending_metrics: deque = deque()
+        
+        # 指標儲存：以平行的 deque 分欄存放（時間為 time.monotonic() 秒數，無標籤時為 None），
+        # 每筆指標不需建立額外物件
+        self._m_ts: deque = deque(maxlen=max_metrics_history)
+        self._m_name: deque = deque(maxlen=max_metrics_history)
+        self._m_value: deque = deque(maxlen=max_metrics_history)
+        self._m_tags: deque = deque(maxlen=max_metrics_history)
         self.error_history: deque = deque(maxlen=max_error_history)
         
         # 統計計數器
-        self.counters: Dict[str, int] = defaultdict(int)
-        self.gauges: Dict[str, float] = defaultdict(float)
+        # 計數器以單元素 list 作為槽位，累加時只需一次字典查詢並原地更新
+        self._counter_slots: Dict[str, List[float]] = {}
+        self.gauges: Dict[str, float] = {}
         
         # 性能追蹤
         self.performance_timers: Dict[str, float] = {}
         
         # 錯誤統計
         self.error_counts: Dict[str, int] = defaultdict(int)
-        self.error_rates: Dict[str, deque] = defaultdict(lambda: deque(maxlen=100))
+        # 每秒一個 [秒數, 次數] 桶（time.monotonic() 取整，依時間遞增），只保留錯誤率視窗內的桶
+        self.error_buckets: Dict[str, deque] = {}
         
         # 任務統計
-        self.task_stats = {
-            "total_tasks": 0,
-            "completed_tasks": 0,
-            "failed_tasks": 0,
-            "retried_tasks": 0,
-            "average_processing_time": 0.0
-        }
+        self.task_stats = TaskStats()
         
         # 處理時間記錄
         self.processing_times: deque = deque(maxlen=100)
+        # processing_times 的總和，隨新增與淘汰增量更新
+        self._processing_sum = 0.0
         
+    @property
+    def counters(self) -> Dict[str, float]:
+        """目前的計數器數值"""
+        return {name: slot[0] for name, slot in self._counter_slots.items()}
+    
     def record_metric(self, metric_name: str, value: float, tags: Dict[str, str] = None):
-        """記錄指標"""
-        if tags is None:
-            tags = {}
+        """記錄指標（只放入待處理緩衝區，由 flush_metrics 批次套用）"""
+        self._pending_metrics.append((time.monotonic(), metric_name, value, tags or None))
+        if len(self._pending_metrics) >= self.max_pending_metrics:
+            self.flush_metrics()
+    
+    def flush_metrics(self) -> int:
+        """
+        將待處理的指標批次寫入歷史記錄與計數器
+        
+        Returns:
+            int: 套用的指標數
+        """
+        pending = self._pending_metrics
+        flushed = 0
+        while pending:
+            batch = [pending.popleft() for _ in range(min(len(pending), self.metrics_batch_size))]
+            # 指標名稱大多重複，intern 後各筆共用同一字串
+            timestamps, names, values, tags = zip(*batch)
+            names = [sys.intern(name) for name in names]
             
-        metric = MetricsData(
-            timestamp=datetime.now(),
-            metric_name=metric_name,
-            value=value,
-            tags=tags
-        )
-        
-        self.metrics_history.append(metric)
-        
-        # 更新計數器或測量儀
-        if metric_name.endswith('_count'):
-            self.counters[metric_name] += value
-        else:
-            self.gauges[metric_name] = value
+            self._m_ts.extend(timestamps)
+            self._m_name.extend(names)
+            self._m_value.extend(values)
+            self._m_tags.extend(tags)
+            
+            # 更新計數器或測量儀
+            counter_slots, gauges = self._counter_slots, self.gauges
+            for name, value in zip(names, values):
+                if name.endswith('_count'):
+                    slot = counter_slots.get(name)
+                    if slot is None:
+                        slot = counter_slots[name] = [0]
+                    slot[0] += value
+                else:
+                    gauges[name] = value
+            
+            flushed += len(batch)
         
-        logger.debug(f"記錄指標: {metric_name} = {value}")
+        if flushed:
+            logger.debug(f"套用 {flushed} 筆指標")
+        return flushed
     
     def record_error(self, error: Exception, task_id: str = None, context: Dict[str, Any] = None):
         """記錄錯誤"""
@@ -97,21 +150,39 @@ class MonitoringService:
             error_type=type(error).__name__,
             error_message=str(error),
             task_id=task_id,
-            stack_trace=traceback.format_exc(),
-            context=context
+            context=context,
+            _raw_tb=traceback.StackSummary.extract(
+                traceback.walk_tb(error.__traceback__), lookup_lines=False
+            ) if error.__traceback__ is not None else None
         )
         
         self.error_history.append(error_event)
         
         # 更新錯誤統計
-        self.error_counts[error_event.error_type] += 1
-        self.error_rates[error_event.error_type].append(datetime.now())
+        error_type = error_event.error_type
+        buckets = self.error_buckets.get(error_type)
+        if buckets is None:
+            if len(self.error_buckets) >= self.max_error_types:
+                error_type = "other"
+                buckets = self.error_buckets.get(error_type)
+            if buckets is None:
+                buckets = self.error_buckets[error_type] = deque(maxlen=self.error_rate_window)
+        
+        now_bucket = int(time.monotonic())
+        if buckets and buckets[-1][0] == now_bucket:
+            buckets[-1][1] += 1
+        else:
+            buckets.append([now_bucket, 1])
+            oldest = now_bucket - self.error_rate_window + 1
+            while buckets[0][0] < oldest:
+                buckets.popleft()
+        self.error_counts[error_type] += 1
         
         logger.error(f"記錄錯誤: {error_event.error_type} - {error_event.error_message}")
         
         # 如果是任務相關錯誤，更新任務統計
         if task_id:
-            self.task_stats["failed_tasks"] += 1
+            self.task_stats.failed_tasks += 1
     
     def start_timer(self, timer_name: str):
         """開始計時器"""
@@ -131,14 +202,33 @@ class MonitoringService:
         
         return elapsed
     
+    def _record_operation_result(self, operation_name: str, elapsed: float, error: Optional[Exception] = None):
+        """
+        記錄被監控操作的耗時與結果
+        
+        Args:
+            operation_name: 操作名稱
+            elapsed: 經過時間（秒）
+            error: 操作失敗時的例外
+        """
+        self.record_metric(f"{operation_name}_operation_duration", elapsed)
+        if error is None:
+            self.record_metric(f"{operation_name}_success_count", 1)
+        else:
+            self.record_error(error, context={"operation": operation_name})
+            self.record_metric(f"{operation_name}_error_count", 1)
+    
     def record_task_completed(self, task_id: str, processing_time: float):
         """記錄任務完成"""
-        self.task_stats["completed_tasks"] += 1
-        self.processing_times.append(processing_time)
+        self.task_stats.completed_tasks += 1
         
-        # 計算平均處理時間
-        if self.processing_times:
-            self.task_stats["average_processing_time"] = sum(self.processing_times) / len(self.processing_times)
+        # 增量更新平均處理時間：deque 已滿時先扣掉即將被淘汰的值
+        times = self.processing_times
+        if len(times) == times.maxlen:
+            self._processing_sum -= times[0]
+        times.append(processing_time)
+        self._processing_sum += processing_time
+        self.task_stats.average_processing_time = self._processing_sum / len(times)
         
         # 記錄指標
         self.record_metric("task_processing_time", processing_time, {"task_id": task_id})
@@ -148,7 +238,7 @@ class MonitoringService:
     
     def record_task_retry(self, task_id: str, retry_count: int):
         """記錄任務重試"""
-        self.task_stats["retried_tasks"] += 1
+        self.task_stats.retried_tasks += 1
         
         # 記錄指標
         self.record_metric("task_retry_count", 1, {"task_id": task_id, "retry_count": str(retry_count)})
@@ -157,29 +247,30 @@ class MonitoringService:
     
     def get_metrics_summary(self) -> Dict[str, Any]:
         """取得指標摘要"""
+        self.flush_metrics()
         now = datetime.now()
         
-        # 計算錯誤率（過去 5 分鐘）
+        # 計算錯誤率（過去 5 分鐘）：先移除超出視窗的桶，再加總剩下的桶（最多 error_rate_window 個）
+        oldest = int(time.monotonic()) - self.error_rate_window + 1
         error_rates_5min = {}
-        for error_type, timestamps in self.error_rates.items():
-            recent_errors = [ts for ts in timestamps if (now - ts).total_seconds() < 300]
-            error_rates_5min[error_type] = len(recent_errors)
+        for error_type, buckets in self.error_buckets.items():
+            while buckets and buckets[0][0] < oldest:
+                buckets.popleft()
+            error_rates_5min[error_type] = sum(count for _, count in buckets)
         
-        # 取得最新的系統指標
+        # 取得最新的系統指標：從最近 50 個指標往回看，每個名稱只取最新的值
         recent_metrics = {}
-        for metric in list(self.metrics_history)[-50:]:  # 最近 50 個指標
-            if metric.metric_name not in recent_metrics or metric.timestamp > recent_metrics[metric.metric_name]["timestamp"]:
-                recent_metrics[metric.metric_name] = {
-                    "value": metric.value,
-                    "timestamp": metric.timestamp
-                }
+        for name, value in islice(zip(reversed(self._m_name), reversed(self._m_value)), 50):
+            if name not in recent_metrics:
+                recent_metrics[name] = value
         
         return {
             "timestamp": now.isoformat(),
-            "task_stats": self.task_stats,
+            # 回傳複本，避免呼叫端修改內部統計
+            "task_stats": asdict(self.task_stats),
             "error_counts": dict(self.error_counts),
             "error_rates_5min": error_rates_5min,
-            "recent_metrics": {k: v["value"] for k, v in recent_metrics.items()},
+            "recent_metrics": recent_metrics,
             "active_timers": list(self.performance_timers.keys()),
             "system_health": self._calculate_system_health()
         }
@@ -187,8 +278,9 @@ class MonitoringService:
     def _calculate_system_health(self) -> str:
         """計算系統健康狀態"""
         # 簡單的健康評估邏輯
-        total_tasks = self.task_stats["total_tasks"]
-        failed_tasks = self.task_stats["failed_tasks"]
+        stats = self.task_stats
+        total_tasks = stats.total_tasks
+        failed_tasks = stats.failed_tasks
         
         if total_tasks == 0:
             return "unknown"
@@ -246,61 +338,51 @@ class MonitoringService:
     
     def clear_old_data(self, days: int = 7):
         """清理舊數據"""
+        self.flush_metrics()
         cutoff_time = datetime.now() - timedelta(days=days)
         
-        # 清理舊的指標數據
-        self.metrics_history = deque(
-            [m for m in self.metrics_history if m.timestamp >= cutoff_time],
-            maxlen=self.max_metrics_history
-        )
-        
-        # 清理舊的錯誤數據
-        self.error_history = deque(
-            [e for e in self.error_history if e.timestamp >= cutoff_time],
-            maxlen=self.max_error_history
-        )
+        # 清理舊的指標數據（時間遞增，從最舊的一端移除）
+        metric_cutoff = time.monotonic() - days * 86400
+        while self._m_ts and self._m_ts[0] < metric_cutoff:
+            self._m_ts.popleft()
+            self._m_name.popleft()
+            self._m_value.popleft()
+            self._m_tags.popleft()
         
-        # 清理錯誤率數據
-        for error_type, timestamps in self.error_rates.items():
-            self.error_rates[error_type] = deque(
-                [ts for ts in timestamps if (datetime.now() - ts).total_seconds() < 3600],
-                maxlen=100
-            )
+        # 清理舊的錯誤數據（錯誤率數據已於 get_metrics_summary 讀取時順便清除）
+        while self.error_history and self.error_history[0].timestamp < cutoff_time:
+            self.error_history.popleft()
         
         logger.info(f"清理 {days} 天前的監控數據")
 
 def performance_monitor(operation_name: str):
     """性能監控裝飾器"""
     def decorator(func):
-        @wraps(func)
-        async def async_wrapper(*args, **kwargs):
-            monitoring_service.start_timer(f"{operation_name}_operation")
-            try:
-                result = await func(*args, **kwargs)
-                elapsed = monitoring_service.stop_timer(f"{operation_name}_operation")
-                monitoring_service.record_metric(f"{operation_name}_success_count", 1)
+        # 各次呼叫以區域變數計時，同一操作併發執行時不會互相覆蓋計時器
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    monitoring_service._record_operation_result(operation_name, time.perf_counter() - start, e)
+                    raise
+                monitoring_service._record_operation_result(operation_name, time.perf_counter() - start)
                 return result
-            except Exception as e:
-                monitoring_service.stop_timer(f"{operation_name}_operation")
-                monitoring_service.record_error(e, context={"operation": operation_name})
-                monitoring_service.record_metric(f"{operation_name}_error_count", 1)
-                raise
-        
-        @wraps(func)
-        def sync_wrapper(*args, **kwargs):
-            monitoring_service.start_timer(f"{operation_name}_operation")
-            try:
-                result = func(*args, **kwargs)
-                elapsed = monitoring_service.stop_timer(f"{operation_name}_operation")
-                monitoring_service.record_metric(f"{operation_name}_success_count", 1)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    monitoring_service._record_operation_result(operation_name, time.perf_counter() - start, e)
+                    raise
+                monitoring_service._record_operation_result(operation_name, time.perf_counter() - start)
                 return result
-            except Exception as e:
-                monitoring_service.stop_timer(f"{operation_name}_operation")
-                monitoring_service.record_error(e, context={"operation": operation_name})
-                monitoring_service.record_metric(f"{operation_name}_error_count", 1)
-                raise
         
-        return async_wrapper if hasattr(func, '__code__') and func.__code__.co_flags & 0x80 else sync_wrapper
+        return wrapper
     
     return decorator
 
@@ -309,4 +391,13 @@ monitoring_service = MonitoringService()
 
 def get_monitoring_service() -> MonitoringService:
     """取得監控服務實例"""
-    return monitoring_service
\ No newline at end of file
+    return monitoring_service
+
+async def metrics_flush_loop(interval: float = 1.0):
+    """定期將緩衝的指標批次寫入監控服務"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            monitoring_service.flush_metrics()
+        except Exception as e:
+            logger.warning(f"套用監控指標失敗: {e}")
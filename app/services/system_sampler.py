@@ -0,0 +1,81 @@
+"""
+系統指標取樣器
+在背景定期取樣 CPU / 記憶體 / GPU 狀態，讓 /status 直接讀取快取而不必阻塞等待
+"""
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+
+import psutil
+
+from app.config import settings
+from app.services.gpu_resource_manager import get_gpu_manager
+
+logger = logging.getLogger(__name__)
+
+
+class SystemSampler:
+    """系統指標取樣器"""
+    
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.snapshot: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+    
+    async def sample(self) -> Dict[str, Any]:
+        """取樣一次並更新快取"""
+        gpu_manager = await get_gpu_manager()
+        gpu_status = await gpu_manager.check_gpu_memory()
+        
+        self.snapshot = {
+            # interval=None 只讀取與上次呼叫之間的差值，不會阻塞
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_percent": psutil.virtual_memory().percent,
+            "gpu_status": gpu_status
+        }
+        return self.snapshot
+    
+    async def get_snapshot(self) -> Dict[str, Any]:
+        """取得最近一次的取樣結果（尚未取樣時立即取樣）"""
+        if not self.snapshot:
+            return await self.sample()
+        return self.snapshot
+    
+    async def start(self):
+        """啟動背景取樣"""
+        if self._task is not None:
+            return
+        
+        psutil.cpu_percent(interval=None)  # 初始化 CPU 計數基準
+        self._task = asyncio.create_task(self._sampling_loop())
+        logger.info("系統指標取樣器啟動")
+    
+    async def stop(self):
+        """停止背景取樣"""
+        if self._task is None:
+            return
+        
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("系統指標取樣器停止")
+    
+    async def _sampling_loop(self):
+        """取樣循環"""
+        while True:
+            try:
+                await self.sample()
+            except Exception as e:
+                logger.warning(f"系統指標取樣失敗: {e}")
+            await asyncio.sleep(self.interval)
+
+
+# 全域取樣器實例
+system_sampler = SystemSampler(interval=settings.status_sample_interval)
+
+def get_system_sampler() -> SystemSampler:
+    """取得系統指標取樣器實例"""
+    return system_sampler
@@ -0,0 +1,328 @@
+"""
+任務儲存服務
+提供程序內（預設）與 Redis 兩種後端，Redis 後端可讓多個 worker 共享任務狀態
+"""
+import asyncio
+import json
+import logging
+from collections import Counter
+from dataclasses import dataclass, field, fields
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 需要計數的任務狀態 -> Redis 計數器鍵
+_COUNTER_KEYS = {
+    "pending": "tasks:pending",
+    "processing": "tasks:active",
+}
+
+# 已結束的任務狀態（可被淘汰）
+_FINISHED_STATES = frozenset({"completed", "failed", "cancelled"})
+
+# 需要還原為 datetime 的欄位
+_DATETIME_FIELDS = ("created_at", "updated_at")
+
+# 狀態轉換腳本：僅在目前狀態符合預期時更新狀態、一併寫入其他欄位並調整計數器（原子操作）
+_TRANSITION_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'status') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2])
+for i = 6, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+if ARGV[3] ~= '' then redis.call('DECR', ARGV[3]) end
+if ARGV[4] ~= '' then redis.call('INCR', ARGV[4]) end
+if ARGV[5] ~= '' then redis.call('EXPIRE', KEYS[1], ARGV[5]) end
+return 1
+"""
+
+
+@dataclass(slots=True)
+class TaskRecord:
+    """任務記錄"""
+    task_id: str
+    status: str
+    created_at: datetime
+    updated_at: datetime
+    progress: int = 0
+    message: Optional[str] = None
+    parameters: Dict[str, Any] = field(default_factory=dict)
+    file_path: Optional[str] = None
+    file_size: int = 0
+    webhook_url: Optional[str] = None
+    result_path: Optional[str] = None
+    result_exists: bool = False  # 完成時已確認結果檔案存在，下載時不需再檢查
+    error_message: Optional[str] = None
+    metadata: Optional[Dict[str, Any]] = None
+    retry_count: int = 0
+    max_retries: int = 3
+    retry_history: List[Dict[str, Any]] = field(default_factory=list)
+
+
+_TASK_FIELDS = tuple(f.name for f in fields(TaskRecord))
+
+
+def _json_default(value: Any) -> Any:
+    """JSON 序列化無法直接處理的型別"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"無法序列化的型別: {type(value).__name__}")
+
+
+class TaskStoreFullError(RuntimeError):
+    """任務表已滿，且沒有可淘汰的已結束任務"""
+
+
+class TaskStore:
+    """任務儲存（程序內實作，僅在單一 worker 內有效）"""
+
+    def __init__(self, maxsize: int = 10000):
+        self._maxsize = maxsize
+        # 各狀態的任務數，於寫入時更新，查詢時不需掃描所有任務
+        self._status_counts: Counter = Counter()
+        self._tasks: Dict[str, TaskRecord] = {}
+        # 已結束的任務 ID（依結束先後排列）；任務表滿時只淘汰已結束的任務，
+        # 等待中與處理中的任務不能消失，否則查詢會回傳 404、worker 的狀態轉換也會失敗
+        self._finished: Dict[str, None] = {}
+
+    async def get(self, task_id: str) -> Optional[TaskRecord]:
+        """取得任務記錄"""
+        return self._tasks.get(task_id)
+
+    async def create(self, task: TaskRecord):
+        """
+        新增任務記錄，任務表已滿時淘汰最早結束的任務
+
+        Raises:
+            TaskStoreFullError: 任務表已滿且所有任務都還在等待或處理中
+        """
+        if task.task_id not in self._tasks and len(self._tasks) >= self._maxsize:
+            if not self._finished:
+                raise TaskStoreFullError(f"任務表已滿 ({self._maxsize})，且沒有已結束的任務可淘汰")
+            self._remove(next(iter(self._finished)))
+
+        self._tasks[task.task_id] = task
+        self._status_counts[task.status] += 1
+        if task.status in _FINISHED_STATES:
+            self._finished[task.task_id] = None
+
+    def _remove(self, task_id: str):
+        """刪除任務並更新狀態計數"""
+        task = self._tasks.pop(task_id)
+        self._status_counts[task.status] -= 1
+        self._finished.pop(task_id, None)
+
+    async def save(self, task: TaskRecord, field_names: Optional[Iterable[str]] = None):
+        """
+        儲存任務欄位（狀態變更請使用 transition）
+
+        Args:
+            task: 任務記錄
+            field_names: 只需寫入的欄位；程序內儲存直接保存物件，不需區分
+        """
+        self._tasks[task.task_id] = task
+
+    async def transition(
+        self,
+        task: TaskRecord,
+        from_state: str,
+        to_state: str,
+        changes: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """
+        變更任務狀態
+
+        Args:
+            task: 任務記錄
+            from_state: 預期的目前狀態，儲存中的狀態不符時不變更
+            to_state: 新狀態
+            changes: 轉換成功時與狀態一併寫入的欄位值
+
+        Returns:
+            bool: 儲存中的狀態與預期相符並已更新時為 True
+        """
+        # task 可能就是儲存中的物件，因此必須與呼叫端預期的狀態比較
+        stored = self._tasks.get(task.task_id)
+        if stored is None or stored.status != from_state:
+            return False
+
+        self._status_counts[from_state] -= 1
+        self._status_counts[to_state] += 1
+        if to_state in _FINISHED_STATES:
+            self._finished[task.task_id] = None
+        for record in (stored, task):
+            record.status = to_state
+            for name, value in (changes or {}).items():
+                setattr(record, name, value)
+        return True
+
+    async def get_counts(self) -> Tuple[int, int]:
+        """
+        取得任務統計
+
+        Returns:
+            Tuple[int, int]: (等待中任務數, 處理中任務數)
+        """
+        return self._status_counts["pending"], self._status_counts["processing"]
+
+    async def evict_finished(self, older_than: datetime) -> int:
+        """
+        淘汰已結束且在指定時間前最後更新的任務
+
+        Args:
+            older_than: 最後更新時間早於此時間的已結束任務會被刪除
+
+        Returns:
+            int: 淘汰的任務數
+        """
+        expired = [
+            task_id for task_id in self._finished
+            if self._tasks[task_id].updated_at < older_than
+        ]
+        for task_id in expired:
+            self._remove(task_id)
+        return len(expired)
+
+
+class RedisTaskStore(TaskStore):
+    """任務儲存（Redis 實作，每個任務一個 hash，並以計數器維護任務統計）"""
+
+    def __init__(self, redis_url: str, retain_seconds: int):
+        import redis.asyncio as redis
+
+        self._retain_seconds = retain_seconds
+        self._redis = redis.from_url(redis_url, decode_responses=True)
+        self._transition_script = self._redis.register_script(_TRANSITION_SCRIPT)
+
+    @staticmethod
+    def _key(task_id: str) -> str:
+        return f"task:{task_id}"
+
+    async def get(self, task_id: str) -> Optional[TaskRecord]:
+        """取得任務記錄"""
+        raw = await self._redis.hgetall(self._key(task_id))
+        if not raw:
+            return None
+
+        values = {
+            name: json.loads(raw[name])
+            for name in _TASK_FIELDS if name in raw
+        }
+        for name in _DATETIME_FIELDS:
+            values[name] = datetime.fromisoformat(values[name])
+        return TaskRecord(**values)
+
+    @staticmethod
+    def _encode(task: TaskRecord, names: Iterable[str] = _TASK_FIELDS) -> Dict[str, str]:
+        return RedisTaskStore._encode_values({name: getattr(task, name) for name in names})
+
+    @staticmethod
+    def _encode_values(values: Dict[str, Any]) -> Dict[str, str]:
+        return {
+            name: json.dumps(value, default=_json_default)
+            for name, value in values.items()
+        }
+
+    async def create(self, task: TaskRecord):
+        """新增任務記錄並計入初始狀態"""
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key(task.task_id), mapping=self._encode(task))
+            if task.status in _COUNTER_KEYS:
+                pipe.incr(_COUNTER_KEYS[task.status])
+            await pipe.execute()
+
+    async def save(self, task: TaskRecord, field_names: Optional[Iterable[str]] = None):
+        """
+        儲存任務欄位（不含 status，狀態僅由 transition 變更）
+
+        Args:
+            task: 任務記錄
+            field_names: 只需寫入的欄位，預設寫入全部欄位
+        """
+        mapping = self._encode(task, _TASK_FIELDS if field_names is None else field_names)
+        mapping.pop("status", None)
+        await self._redis.hset(self._key(task.task_id), mapping=mapping)
+
+    async def transition(
+        self,
+        task: TaskRecord,
+        from_state: str,
+        to_state: str,
+        changes: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """
+        以原子操作變更任務狀態並調整計數器
+
+        Args:
+            task: 任務記錄
+            from_state: 預期的目前狀態，Redis 中的狀態不符時不變更
+            to_state: 新狀態
+            changes: 轉換成功時與狀態一併寫入的欄位值，省去額外一次 save 往返
+
+        Returns:
+            bool: Redis 中的狀態與預期相符並已更新時為 True
+        """
+        mapping = self._encode_values(changes or {})
+        mapping.pop("status", None)
+        changed = await self._transition_script(
+            keys=[self._key(task.task_id)],
+            args=[
+                json.dumps(from_state),
+                json.dumps(to_state),
+                _COUNTER_KEYS.get(from_state, ""),
+                _COUNTER_KEYS.get(to_state, ""),
+                # 結束的任務交由 Redis 在保留時間後自動刪除
+                self._retain_seconds if to_state in _FINISHED_STATES else "",
+                *(item for pair in mapping.items() for item in pair),
+            ]
+        )
+        if changed:
+            task.status = to_state
+            for name, value in (changes or {}).items():
+                setattr(task, name, value)
+        return bool(changed)
+
+    async def get_counts(self) -> Tuple[int, int]:
+        """
+        取得任務統計（直接讀取計數器）
+
+        Returns:
+            Tuple[int, int]: (等待中任務數, 處理中任務數)
+        """
+        pending, active = await self._redis.mget(
+            _COUNTER_KEYS["pending"], _COUNTER_KEYS["processing"]
+        )
+        return int(pending or 0), int(active or 0)
+
+    async def evict_finished(self, older_than: datetime) -> int:
+        """已結束的任務由 EXPIRE 自動淘汰，不需掃描"""
+        return 0
+
+
+@lru_cache(maxsize=1)
+def get_task_store() -> TaskStore:
+    """取得任務儲存單例（依設定選擇後端）"""
+    if settings.task_store_backend == "redis":
+        logger.info(f"使用 Redis 任務儲存: {settings.get_redis_url()}")
+        return RedisTaskStore(settings.get_redis_url(), settings.task_retain_hours * 3600)
+    return TaskStore(maxsize=settings.task_table_size)
+
+
+async def task_eviction_loop(interval: float = 300):
+    """定期淘汰已結束且超過保留時間的任務，釋放任務表記憶體"""
+    task_store = get_task_store()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(hours=settings.task_retain_hours)
+            evicted = await task_store.evict_finished(cutoff)
+            if evicted:
+                logger.info(f"已淘汰 {evicted} 個過期任務")
+        except Exception as e:
+            logger.warning(f"淘汰過期任務失敗: {e}")
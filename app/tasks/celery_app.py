@@ -0,0 +1,19 @@
+"""
+Celery 應用程式
+處理任務送入專用的 gpu 隊列，由單一併發的 worker 獨佔 GPU：
+
+    celery -A app.tasks.celery_app worker -Q gpu --concurrency=1
+"""
+from celery import Celery
+
+from app.config import settings
+from app.tasks.processing import setup_celery_tasks
+
+celery_app = Celery(
+    "depthflow",
+    broker=settings.celery_broker_url,
+    backend=settings.celery_result_backend
+)
+celery_app.conf.task_routes = {"process_image": {"queue": "gpu"}}
+
+process_image_celery_task = setup_celery_tasks(celery_app)
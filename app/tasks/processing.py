@@ -1,15 +1,90 @@
+import atexit
 import logging
-from typing import Dict, Any
-from datetime import datetime
+import random
+import re
+import threading
+import time
+import weakref
+from contextlib import AsyncExitStack
+from typing import Dict, Any, Set
+from datetime import datetime, timezone
 import asyncio
 
 from app.services.depthflow import DepthFlowService
-from app.services.file_handler import FileHandler
+from app.services.file_handler import get_file_handler
 from app.services.gpu_resource_manager import get_gpu_manager
 from app.services.monitoring import get_monitoring_service, performance_monitor
+from app.services.task_store import TaskRecord, get_task_store
+from app.tasks.webhook_batcher import close_webhook_delivery, get_webhook_batcher
 
 logger = logging.getLogger(__name__)
 
+# 進度更新只變動的任務欄位，儲存時不需重新序列化整筆記錄
+_PROGRESS_FIELDS = ("progress", "message", "updated_at")
+
+# 相同訊息的進度更新最短間隔（秒）
+_PROGRESS_MIN_INTERVAL = 0.1
+
+# 各事件循環上背景執行中的清理工作（保留參照避免執行中被回收）；
+# Celery 每個 worker 執行緒使用各自的循環，只能等待自己循環上的工作
+_cleanup_tasks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Set[asyncio.Task]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+# 不應該重試的錯誤類型
+_NON_RETRYABLE_ERRORS = (
+    "無效的圖片檔案",
+    "檔案格式不支援",
+    "檔案損壞",
+    "parameter_validation_error",
+    "invalid_file_format",
+    "file_too_large"
+)
+
+# 應該重試的錯誤類型
+_RETRYABLE_ERRORS = (
+    "gpu",
+    "memory",
+    "timeout",
+    "connection",
+    "temporary",
+    "資源不足",
+    "服務器忙碌",
+    "processing failed"
+)
+
+# 預先編譯成不分大小寫的正規表示式，每個錯誤訊息只需各掃描一次
+_NON_RETRYABLE_RE = re.compile("|".join(map(re.escape, _NON_RETRYABLE_ERRORS)), re.IGNORECASE)
+_RETRYABLE_RE = re.compile("|".join(map(re.escape, _RETRYABLE_ERRORS)), re.IGNORECASE)
+
+# GPU 相關錯誤的關鍵字，只有這類錯誤重試前需要清理 GPU 記憶體
+_GPU_ERROR_RE = re.compile("gpu|cuda|memory|oom", re.IGNORECASE)
+
+
+def _build_error_automaton():
+    """
+    以 pyahocorasick 建立多字串比對自動機，一次掃描即可分類錯誤訊息
+    
+    Returns:
+        ahocorasick.Automaton: 值為是否可重試的自動機，未安裝 pyahocorasick 時為 None
+    """
+    try:
+        import ahocorasick
+    except ImportError:
+        return None
+    
+    automaton = ahocorasick.Automaton()
+    for term in _NON_RETRYABLE_ERRORS:
+        automaton.add_word(term.lower(), False)
+    for term in _RETRYABLE_ERRORS:
+        automaton.add_word(term.lower(), True)
+    automaton.make_automaton()
+    return automaton
+
+
+_ERROR_AUTOMATON = _build_error_automaton()
+
 
 def should_retry_error(error: Exception) -> bool:
     """
@@ -21,50 +96,72 @@ def should_retry_error(error: Exception) -> bool:
     Returns:
         bool: 是否應該重試
     """
-    error_str = str(error).lower()
+    error_str = str(error)
     
-    # 不應該重試的錯誤類型
-    non_retryable_errors = [
-        "無效的圖片檔案",
-        "檔案格式不支援",
-        "檔案損壞",
-        "parameter_validation_error",
-        "invalid_file_format",
-        "file_too_large"
-    ]
+    if _ERROR_AUTOMATON is not None:
+        # 任何不可重試的字詞都優先；只命中可重試字詞或都沒命中時皆重試
+        for _, retryable in _ERROR_AUTOMATON.iter(error_str.lower()):
+            if not retryable:
+                return False
+        return True
     
+    # 未安裝 pyahocorasick 時改用正規表示式
     # 檢查是否為不可重試的錯誤
-    for non_retryable in non_retryable_errors:
-        if non_retryable in error_str:
-            return False
-    
-    # 應該重試的錯誤類型
-    retryable_errors = [
-        "gpu",
-        "memory",
-        "timeout",
-        "connection",
-        "temporary",
-        "資源不足",
-        "服務器忙碌",
-        "processing failed"
-    ]
+    if _NON_RETRYABLE_RE.search(error_str):
+        return False
     
     # 檢查是否為可重試的錯誤
-    for retryable in retryable_errors:
-        if retryable in error_str:
-            return True
+    if _RETRYABLE_RE.search(error_str):
+        return True
     
     # 預設情況下，大多數錯誤都可以重試
     return True
 
 
+def is_gpu_related_error(error: Exception) -> bool:
+    """
+    判斷錯誤是否與 GPU 相關
+    
+    Args:
+        error: 發生的錯誤
+        
+    Returns:
+        bool: 是否為 GPU 相關錯誤
+    """
+    return _GPU_ERROR_RE.search(str(error)) is not None
+
+
+def _on_cleanup_done(cleanup: asyncio.Task):
+    """背景清理結束時移除參照並記錄錯誤"""
+    _cleanup_tasks.get(cleanup.get_loop(), set()).discard(cleanup)
+    if not cleanup.cancelled() and cleanup.exception() is not None:
+        logger.error(f"清理任務檔案失敗: {cleanup.exception()}")
+
+
+def schedule_task_cleanup(task_id: str):
+    """
+    在背景清理任務檔案，失敗狀態不需等待檔案刪除即可回報
+    
+    Args:
+        task_id: 任務 ID
+    """
+    cleanup = asyncio.create_task(get_file_handler().cleanup_task_files(task_id))
+    _cleanup_tasks.setdefault(cleanup.get_loop(), set()).add(cleanup)
+    cleanup.add_done_callback(_on_cleanup_done)
+
+
+async def wait_for_cleanup_tasks():
+    """等待目前事件循環上的背景清理工作完成"""
+    pending = _cleanup_tasks.get(asyncio.get_running_loop())
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
 @performance_monitor("image_processing")
 async def process_image_task(
     task_id: str,
     file_path: str,
-    parameters: Dict[str, Any],
-    tasks_db: Dict[str, Any]
+    parameters: Dict[str, Any]
 ):
     """
     處理圖片的非同步任務
@@ -73,200 +170,262 @@ async def process_image_task(
         task_id: 任務 ID
         file_path: 輸入檔案路徑
         parameters: 處理參數
-        tasks_db: 任務資料庫（暫時）
     """
     logger.info(f"開始處理任務: {task_id}")
     
     # 更新任務狀態
-    task = tasks_db.get(task_id)
+    task_store = get_task_store()
+    task = await task_store.get(task_id)
     if not task:
         logger.error(f"找不到任務: {task_id}")
         return
     
     # 初始化服務
     depthflow_service = DepthFlowService()
-    file_handler = FileHandler()
+    file_handler = get_file_handler()
     gpu_manager = await get_gpu_manager()
     monitoring_service = get_monitoring_service()
     
     # 記錄任務開始
-    task_start_time = datetime.utcnow()
+    task_start_time = time.monotonic()
     monitoring_service.record_metric("task_started_count", 1, {"task_id": task_id})
     
-    try:
-        # 更新為處理中
-        task['status'] = 'processing'
-        task['updated_at'] = datetime.utcnow()
-        task['message'] = '正在處理圖片...'
-        
-        # 驗證圖片
-        is_valid = await file_handler.validate_image(file_path)
-        if not is_valid:
-            raise Exception("無效的圖片檔案")
-        
-        # 進度回調函數
-        async def update_progress(progress: int, message: str):
-            task['progress'] = progress
-            task['message'] = message
-            task['updated_at'] = datetime.utcnow()
-            logger.info(f"任務 {task_id} 進度: {progress}% - {message}")
-        
-        # 取得輸出路徑
-        output_format = parameters.get('output_format', 'mp4')
-        output_path = file_handler.get_output_path(task_id, output_format)
-        
-        # 檢查 GPU 資源並取得處理槽位
-        task['message'] = '等待 GPU 資源...'
-        await update_progress(10, '等待 GPU 資源...')
-        
-        # 使用 GPU 資源管理器取得槽位
-        async with gpu_manager.acquire_gpu_slot(task_id):
-            task['message'] = '開始 GPU 處理...'
-            await update_progress(20, '開始 GPU 處理...')
-            
-            # 處理圖片
-            success = await depthflow_service.process_image(
-                input_path=file_path,
-                output_path=output_path,
-                parameters=parameters,
-                progress_callback=update_progress
-            )
+    # 進度回調函數：訊息不變且進度未前進 1% 的更新，100ms 內只寫入一次
+    last_emit = 0.0
+    
+    async def update_progress(progress: int, message: str):
+        nonlocal last_emit
+        # 任務已被取消時不再寫入進度
+        if task.status != 'processing':
+            return
+        now = time.monotonic()
+        if (progress < 100 and message == task.message and progress - task.progress < 1
+                and now - last_emit < _PROGRESS_MIN_INTERVAL):
+            return
+        last_emit = now
         
-        if success:
-            # 更新為完成
-            task['status'] = 'completed'
-            task['progress'] = 100
-            task['message'] = '處理完成'
-            task['result_path'] = output_path
-            task['updated_at'] = datetime.utcnow()
-            
-            # 計算處理時間
-            processing_time = (task['updated_at'] - task_start_time).total_seconds()
-            
-            # 取得檔案資訊
-            file_info = file_handler.get_file_info(output_path)
-            if file_info:
-                task['metadata'] = {
-                    'output_size': file_info['size'],
-                    'processing_time': processing_time
-                }
-            
-            # 記錄成功完成
-            monitoring_service.record_task_completed(task_id, processing_time)
-            
-            logger.info(f"任務完成: {task_id}")
+        task.progress = progress
+        task.message = message
+        task.updated_at = datetime.now(timezone.utc)
+        await task_store.save(task, _PROGRESS_FIELDS)
+        logger.info(f"任務 {task_id} 進度: {progress}% - {message}")
+    
+    # 取得輸出路徑
+    output_format = parameters.get('output_format', 'mp4')
+    output_path = file_handler.get_output_path(task_id, output_format)
+    
+    # 重試以迴圈進行，重試次數受 task.max_retries 限制
+    while True:
+        try:
+            # 更新為處理中；任務已被取消時不取得 GPU 槽位，直接結束
+            if not await task_store.transition(task, 'pending', 'processing', {
+                'message': '正在處理圖片...',
+                'updated_at': datetime.now(timezone.utc)
+            }):
+                logger.warning(f"任務 {task_id} 已不在等待中（可能已取消），停止處理")
+                return
             
-            # 如果有 webhook，發送通知
-            if task.get('webhook_url'):
-                await send_webhook_notification(task)
-        else:
-            raise Exception("DepthFlow 處理失敗")
+            async with AsyncExitStack() as gpu_slot:
+                # 使用 GPU 資源管理器取得槽位（以預估處理時間排隊，短任務不必排在長任務之後），
+                # 排隊的同時驗證並解碼圖片
+                slot_task = asyncio.create_task(gpu_slot.enter_async_context(
+                    gpu_manager.acquire_gpu_slot(
+                        task_id, priority=depthflow_service.estimate_processing_time(parameters)
+                    )
+                ))
+                
+                try:
+                    # 驗證並解碼圖片（解碼結果直接交給 DepthFlow）
+                    is_valid, image = await file_handler.validate_and_decode(file_path)
+                    if not is_valid:
+                        raise Exception("無效的圖片檔案")
+                except BaseException:
+                    # 放棄排隊；已取得的槽位由 AsyncExitStack 釋放
+                    slot_task.cancel()
+                    await asyncio.gather(slot_task, return_exceptions=True)
+                    raise
+                
+                # 檢查 GPU 資源並取得處理槽位
+                await update_progress(10, '等待 GPU 資源...')
+                await slot_task
+                await update_progress(20, '開始 GPU 處理...')
+                
+                # 處理圖片
+                success = await depthflow_service.process_image(
+                    input_path=file_path,
+                    output_path=output_path,
+                    parameters=parameters,
+                    progress_callback=update_progress,
+                    image=image
+                )
             
-    except Exception as e:
-        logger.error(f"任務失敗: {task_id}, 錯誤: {e}")
-        
-        # 記錄錯誤到監控服務
-        monitoring_service.record_error(e, task_id, {
-            "operation": "image_processing",
-            "file_path": file_path,
-            "parameters": parameters
-        })
-        
-        # 檢查是否應該重試
-        retry_count = task.get('retry_count', 0)
-        max_retries = task.get('max_retries', 3)
-        
-        if retry_count < max_retries and should_retry_error(e):
-            # 準備重試
-            retry_count += 1
-            task['retry_count'] = retry_count
-            task['status'] = 'pending'
-            task['message'] = f'處理失敗，準備重試 ({retry_count}/{max_retries})'
-            task['updated_at'] = datetime.utcnow()
+            if success:
+                # 計算處理時間
+                processing_time = time.monotonic() - task_start_time
+                
+                # 取得檔案資訊
+                file_info = await file_handler.get_file_info(output_path)
+                
+                # 更新為完成；任務已被取消時捨棄結果
+                if not await task_store.transition(task, 'processing', 'completed', {
+                    'progress': 100,
+                    'message': '處理完成',
+                    'result_path': output_path,
+                    'result_exists': file_info is not None,
+                    'metadata': {
+                        'output_size': file_info['size'],
+                        'processing_time': processing_time
+                    } if file_info else task.metadata,
+                    'updated_at': datetime.now(timezone.utc)
+                }):
+                    logger.warning(f"任務 {task_id} 已不在處理中（可能已取消），捨棄處理結果")
+                    schedule_task_cleanup(task_id)
+                    return
+                
+                # 記錄成功完成
+                monitoring_service.record_task_completed(task_id, processing_time)
+                
+                logger.info(f"任務完成: {task_id}")
+                
+                # 如果有 webhook，發送通知
+                if task.webhook_url:
+                    await send_webhook_notification(task)
+                return
+            else:
+                raise Exception("DepthFlow 處理失敗")
+                
+        except Exception as e:
+            error_str = str(e)
+            logger.error(f"任務失敗: {task_id}, 錯誤: {error_str}")
             
-            # 記錄重試歷史
-            if 'retry_history' not in task:
-                task['retry_history'] = []
-            task['retry_history'].append({
-                'attempt': retry_count,
-                'error': str(e),
-                'timestamp': datetime.utcnow().isoformat()
+            # 記錄錯誤到監控服務
+            monitoring_service.record_error(e, task_id, {
+                "operation": "image_processing",
+                "file_path": file_path,
+                "parameters": parameters
             })
             
-            # 記錄重試到監控服務
-            monitoring_service.record_task_retry(task_id, retry_count)
-            
-            # 計算重試延遲（指數退避）
-            delay = min(60 * (2 ** (retry_count - 1)), 300)  # 最多 5 分鐘
-            logger.info(f"任務 {task_id} 將在 {delay} 秒後重試")
-            
-            # 清理 GPU 記憶體
-            try:
-                await gpu_manager.cleanup_gpu_memory()
-            except:
-                pass
+            # 檢查是否應該重試
+            retry_count = task.retry_count
+            max_retries = task.max_retries
             
-            # 安排重試
-            await asyncio.sleep(delay)
-            await process_image_task(task_id, file_path, parameters, tasks_db)
-            return
-        else:
-            # 已達重試上限或不可重試的錯誤
-            task['status'] = 'failed'
-            task['message'] = '處理失敗'
-            task['error_message'] = str(e)
-            task['updated_at'] = datetime.utcnow()
-            
-            # 記錄最終失敗
-            monitoring_service.record_metric("task_failed_count", 1, {"task_id": task_id})
-            
-            # 清理檔案
-            file_handler.cleanup_task_files(task_id)
+            if retry_count < max_retries and should_retry_error(e):
+                # 準備重試
+                retry_count += 1
+                now = datetime.now(timezone.utc)
+                
+                # 記錄重試歷史，只保留最近幾次的重試記錄（保持 list 以便直接序列化為 JSON）
+                retry_history = task.retry_history + [{
+                    'attempt': retry_count,
+                    'error': error_str,
+                    'timestamp': now.isoformat()
+                }]
+                del retry_history[:-(max_retries + 2)]
+                
+                if not await task_store.transition(task, 'processing', 'pending', {
+                    'retry_count': retry_count,
+                    'message': f'處理失敗，準備重試 ({retry_count}/{max_retries})',
+                    'updated_at': now,
+                    'retry_history': retry_history
+                }):
+                    logger.warning(f"任務 {task_id} 已不在處理中（可能已取消），不再重試")
+                    schedule_task_cleanup(task_id)
+                    return
+                
+                # 記錄重試到監控服務
+                monitoring_service.record_task_retry(task_id, retry_count)
+                
+                # 計算重試延遲（指數退避加上隨機抖動，避免同時失敗的任務一起重試）
+                delay = random.uniform(1.0, min(60 * (2 ** (retry_count - 1)), 300))  # 最多 5 分鐘
+                logger.info(f"任務 {task_id} 將在 {delay:.1f} 秒後重試")
+                
+                # 只有 GPU 相關錯誤才清理 GPU 記憶體（empty_cache 會同步裝置並清空快取）
+                if is_gpu_related_error(e):
+                    try:
+                        await gpu_manager.cleanup_gpu_memory()
+                    except:
+                        pass
+                
+                # 等待後在同一次呼叫內重試，沿用已初始化的服務
+                await asyncio.sleep(delay)
+                continue
+            else:
+                # 已達重試上限或不可重試的錯誤；任務已被取消時不記錄失敗
+                if await task_store.transition(task, 'processing', 'failed', {
+                    'message': '處理失敗',
+                    'error_message': error_str,
+                    'updated_at': datetime.now(timezone.utc)
+                }):
+                    # 記錄最終失敗
+                    monitoring_service.record_metric("task_failed_count", 1, {"task_id": task_id})
+                else:
+                    logger.warning(f"任務 {task_id} 已不在處理中（可能已取消），不記錄失敗")
+                
+                # 在背景清理檔案
+                schedule_task_cleanup(task_id)
+                return
 
 
-async def send_webhook_notification(task: Dict[str, Any]):
+async def send_webhook_notification(task: TaskRecord):
     """
     發送 Webhook 通知
     
     Args:
         task: 任務資訊
     """
-    webhook_url = task.get('webhook_url')
+    webhook_url = task.webhook_url
     if not webhook_url:
         return
     
     try:
-        import httpx
-        
         # 準備通知資料
+        task_id = task.task_id
         notification_data = {
-            'task_id': task['task_id'],
-            'status': task['status'],
-            'message': task.get('message'),
-            'result_url': f"/api/v1/result/{task['task_id']}",
-            'metadata': task.get('metadata', {})
+            'task_id': task_id,
+            'status': task.status,
+            'message': task.message,
+            'result_url': f"/api/v1/result/{task_id}",
+            'metadata': task.metadata or {}
         }
         
-        # 發送 POST 請求
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                webhook_url,
-                json=notification_data,
-                timeout=30.0
-            )
-            
-            if response.status_code >= 200 and response.status_code < 300:
-                logger.info(f"Webhook 通知成功: {webhook_url}")
-            else:
-                logger.warning(
-                    f"Webhook 通知失敗: {webhook_url}, "
-                    f"狀態碼: {response.status_code}"
-                )
-                
+        # 交由批次發送器在背景送出，任務不需等待 HTTP 往返
+        await get_webhook_batcher().enqueue(webhook_url, notification_data)
+        
     except Exception as e:
         logger.error(f"發送 Webhook 通知失敗: {e}")
 
 
+# Celery worker 的事件循環：每個執行緒建立一次並在任務之間重複使用
+_worker_loop = threading.local()
+
+
+def _get_worker_loop() -> asyncio.AbstractEventLoop:
+    """取得目前執行緒的 worker 事件循環（第一次呼叫時建立）"""
+    loop = getattr(_worker_loop, 'loop', None)
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        _worker_loop.loop = loop
+        atexit.register(_close_worker_loop, loop)
+    return loop
+
+
+async def _finish_worker_task():
+    """
+    Celery 任務結束前送出剩餘的通知並等待背景清理（任務之間事件循環不會執行）；
+    延遲重送的通知不佔用 GPU worker，留待下一個任務執行時或 worker 結束時送出
+    """
+    await get_webhook_batcher().close(wait_for_retries=False)
+    await wait_for_cleanup_tasks()
+
+
+def _close_worker_loop(loop: asyncio.AbstractEventLoop):
+    """worker 結束時送出剩餘的通知並關閉事件循環"""
+    if not loop.is_closed():
+        loop.run_until_complete(close_webhook_delivery())
+        loop.close()
+
+
 # Celery 任務定義（當整合 Celery 時使用）
 def setup_celery_tasks(celery_app):
     """
@@ -276,24 +435,22 @@ def setup_celery_tasks(celery_app):
         celery_app: Celery 應用實例
     """
     
-    @celery_app.task(name='process_image')
+    @celery_app.task(name='process_image', queue='gpu')
     def celery_process_image_task(
         task_id: str,
         file_path: str,
         parameters: Dict[str, Any]
     ):
         """Celery 任務包裝器"""
-        # 在 Celery worker 中執行非同步任務
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        # 在 Celery worker 中執行非同步任務（沿用同一個事件循環）
+        loop = _get_worker_loop()
         
         try:
-            # 注意：這裡需要存取共享的任務資料庫（Redis 或資料庫）
-            # 而不是記憶體中的 tasks_db
+            # 注意：Celery worker 需設定 TASK_STORE_BACKEND=redis 才能與 API 共享任務狀態
             loop.run_until_complete(
-                process_image_task(task_id, file_path, parameters, {})
+                process_image_task(task_id, file_path, parameters)
             )
         finally:
-            loop.close()
+            loop.run_until_complete(_finish_worker_task())
     
     return celery_process_image_task
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""
+Webhook 通知批次發送
+任務完成時只把通知放入佇列，由背景協程在短時間窗內收集後依 URL 分組送出
+"""
+import asyncio
+import logging
+import weakref
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import httpx
+import orjson
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 預先以 orjson 序列化，送出時直接傳遞位元組
+_JSON_HEADERS = {"content-type": "application/json"}
+
+# 暫時性失敗（5xx 或連線錯誤）後重送前的等待時間（秒），只重送一次
+_WEBHOOK_RETRY_DELAY = 5.0
+
+
+def get_webhook_client() -> httpx.AsyncClient:
+    """取得目前事件循環的 Webhook HTTP 客戶端（第一次使用時建立）"""
+    return get_webhook_batcher().client
+
+
+async def post_webhook(webhook_url: str, data: Any) -> bool:
+    """
+    發送單一 Webhook POST 請求
+    
+    Args:
+        webhook_url: Webhook URL
+        data: JSON 內容（單一通知或通知陣列）
+        
+    Returns:
+        bool: 失敗且值得重送（5xx 或連線錯誤）時為 True
+    """
+    try:
+        response = await get_webhook_client().post(
+            webhook_url,
+            content=orjson.dumps(data),
+            headers=_JSON_HEADERS
+        )
+    except Exception as e:
+        logger.warning(f"發送 Webhook 通知失敗: {webhook_url}, {e}")
+        return True
+    
+    status_code = response.status_code
+    if 200 <= status_code < 300:
+        logger.info(f"Webhook 通知成功: {webhook_url}")
+        return False
+    
+    if 400 <= status_code < 500:
+        # 4xx 表示 Webhook 設定有誤，重送也不會成功
+        logger.error(f"Webhook 通知被拒絕: {webhook_url}, 狀態碼: {status_code}")
+        return False
+    
+    logger.warning(f"Webhook 通知失敗: {webhook_url}, 狀態碼: {status_code}")
+    return status_code >= 500
+
+
+class WebhookBatcher:
+    """Webhook 通知批次發送器（每個事件循環各一個，只在該循環上使用）"""
+    
+    def __init__(self, window: float = 0.05, max_batch: int = 32):
+        """
+        Args:
+            window: 收集通知的時間窗（秒）
+            max_batch: 每批最多的通知數
+        """
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # 等待重送的通知（保留參照避免被回收）
+        self._retries: Set[asyncio.Task] = set()
+        # HTTP 客戶端，保留連線供之後的通知重用
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """HTTP 客戶端（第一次使用時建立）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=30.0,
+                limits=httpx.Limits(max_keepalive_connections=32)
+            )
+        return self._client
+    
+    async def enqueue(self, webhook_url: str, payload: Dict[str, Any]):
+        """
+        將通知放入佇列，由背景協程送出
+        
+        Args:
+            webhook_url: Webhook URL
+            payload: 通知內容
+        """
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run(self._queue))
+        self._queue.put_nowait((webhook_url, payload))
+    
+    async def close(self, wait_for_retries: bool = True):
+        """
+        送出佇列中剩餘的通知並停止背景協程
+        
+        Args:
+            wait_for_retries: 是否等待排定的重送完成；不等待時重送留在事件循環上，
+                於之後循環再次執行時送出
+        """
+        if self._worker is not None:
+            self._queue.put_nowait(None)
+            await self._worker
+            self._worker = None
+            self._queue = None
+        
+        if wait_for_retries and self._retries:
+            await asyncio.gather(*self._retries)
+    
+    async def close_client(self):
+        """關閉 HTTP 客戶端"""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+    
+    async def _run(self, queue: asyncio.Queue):
+        """收集時間窗內的通知並依 URL 分組送出"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            
+            batch: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+            batch[item[0]].append(item[1])
+            count = 1
+            deadline = loop.time() + self.window
+            
+            while count < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    await self._deliver(batch)
+                    return
+                batch[item[0]].append(item[1])
+                count += 1
+            
+            await self._deliver(batch)
+    
+    async def _deliver(self, batch: Dict[str, List[Dict[str, Any]]]):
+        """
+        送出一批通知：啟用批次模式時同一 URL 的多個通知合併為 JSON 陣列，否則逐一送出
+        
+        Args:
+            batch: 依 URL 分組的通知
+        """
+        requests: List[Tuple[str, Any]] = []
+        for webhook_url, payloads in batch.items():
+            if settings.webhook_batch_enabled and len(payloads) > 1:
+                requests.append((webhook_url, payloads))
+            else:
+                requests.extend((webhook_url, payload) for payload in payloads)
+        
+        retriable = await asyncio.gather(*(post_webhook(url, data) for url, data in requests))
+        
+        # 暫時性失敗在背景延遲後重送一次，不阻塞下一批通知
+        for (webhook_url, data), retry in zip(requests, retriable):
+            if retry:
+                task = asyncio.create_task(self._retry(webhook_url, data))
+                self._retries.add(task)
+                task.add_done_callback(self._retries.discard)
+    
+    async def _retry(self, webhook_url: str, data: Any):
+        """等待後重送一次失敗的通知"""
+        await asyncio.sleep(_WEBHOOK_RETRY_DELAY)
+        if await post_webhook(webhook_url, data):
+            logger.error(f"Webhook 通知重送後仍失敗，放棄: {webhook_url}")
+
+
+# 各事件循環的 Webhook 批次發送器：佇列、背景協程與連線都綁定在所屬的循環上，
+# Celery 每個 worker 執行緒使用各自的循環，不能共用同一個實例
+_batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, WebhookBatcher]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_webhook_batcher() -> WebhookBatcher:
+    """取得目前事件循環的 Webhook 批次發送器實例"""
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = WebhookBatcher()
+    return batcher
+
+
+async def close_webhook_delivery():
+    """送出目前事件循環剩餘的通知並關閉 HTTP 客戶端"""
+    batcher = _batchers.pop(asyncio.get_running_loop(), None)
+    if batcher is not None:
+        await batcher.close()
+        await batcher.close_client()
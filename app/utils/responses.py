@@ -0,0 +1,25 @@
+"""
+回應類別
+"""
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+def _orjson_default(value: Any) -> Any:
+    """處理 orjson 無法直接序列化的型別（pydantic 模型）"""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    raise TypeError(f"無法序列化的型別: {type(value).__name__}")
+
+
+class ORJSONResponse(JSONResponse):
+    """以 orjson 序列化的 JSON 回應，原生支援 datetime / UUID"""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=_orjson_default,
+            option=orjson.OPT_NON_STR_KEYS
+        )
@@ -83,4 +83,114 @@ async def test_file_validation():
     assert validate_file_extension("image.png") == True
     assert validate_file_extension("image.gif") == False
     assert validate_file_extension("document.pdf") == False
-    assert validate_file_extension(None) == False
\ No newline at end of file
+    assert validate_file_extension(None) == False
+
+@pytest.mark.asyncio
+async def test_api_key_cache(monkeypatch):
+    """測試 API Key 驗證快取與失效"""
+    from fastapi import HTTPException
+    from app.api import dependencies
+    from app.config import settings
+    
+    monkeypatch.setattr(settings, "api_key_enabled", True)
+    monkeypatch.setattr(settings, "api_key", "secret")
+    dependencies.invalidate_api_key()
+    
+    assert await dependencies.verify_api_key("secret") == "secret"
+    assert "secret" in dependencies._KEY_CACHE
+    
+    with pytest.raises(HTTPException):
+        await dependencies.verify_api_key("wrong")
+    
+    dependencies.invalidate_api_key("secret")
+    assert "secret" not in dependencies._KEY_CACHE
+
+
+@pytest.mark.asyncio
+async def test_task_store_transition():
+    """測試任務狀態轉換與統計"""
+    from datetime import datetime, timezone
+    from app.services.task_store import TaskRecord, TaskStore
+    
+    now = datetime.now(timezone.utc)
+    store = TaskStore()
+    await store.create(TaskRecord(task_id="t1", status="pending", created_at=now, updated_at=now))
+    assert await store.get_counts() == (1, 0)
+    
+    task = await store.get("t1")
+    assert await store.transition(task, "pending", "processing", {"message": "處理中"})
+    assert await store.get_counts() == (0, 1)
+    assert (await store.get("t1")).message == "處理中"
+    
+    # 轉換前狀態不符時不應更新
+    assert not await store.transition(task, "pending", "cancelled")
+    assert (await store.get("t1")).status == "processing"
+
+
+@pytest.mark.asyncio
+async def test_task_store_transition_after_cancel():
+    """測試任務取消後，worker 持有的同一物件無法再轉換狀態"""
+    from datetime import datetime, timezone
+    from app.services.task_store import TaskRecord, TaskStore
+    
+    now = datetime.now(timezone.utc)
+    store = TaskStore()
+    await store.create(TaskRecord(task_id="t1", status="pending", created_at=now, updated_at=now))
+    
+    # worker 與取消請求取得的是同一個物件
+    worker_task = await store.get("t1")
+    assert await store.transition(await store.get("t1"), "pending", "cancelled")
+    
+    assert not await store.transition(worker_task, "pending", "processing")
+    assert not await store.transition(worker_task, "processing", "completed", {"progress": 100})
+    
+    task = await store.get("t1")
+    assert task.status == "cancelled"
+    assert task.progress == 0
+    assert await store.get_counts() == (0, 0)
+
+
+def test_upload_invalid_request_json():
+    """測試無效的處理參數"""
+    files = {"file": ("test.jpg", b"fake", "image/jpeg")}
+    
+    response = client.post("/api/v1/process", files=files, data={"request": "{not json"})
+    assert response.status_code == 400
+    assert response.json()["detail"]["error"] == "invalid_json"
+    
+    response = client.post("/api/v1/process", files=files, data={"request": '{"parameters": {"fps": 1000}}'})
+    assert response.status_code == 400
+    assert response.json()["detail"]["error"] == "parameter_validation_error"
+
+
+@pytest.mark.asyncio
+async def test_task_store_evict_finished():
+    """測試淘汰已結束的過期任務"""
+    from datetime import datetime, timedelta, timezone
+    from app.services.task_store import TaskRecord, TaskStore, TaskStoreFullError
+    
+    def record(task_id, updated_at):
+        return TaskRecord(task_id=task_id, status="pending", created_at=updated_at, updated_at=updated_at)
+    
+    now = datetime.now(timezone.utc)
+    store = TaskStore(maxsize=2)
+    await store.create(record("old", now - timedelta(days=2)))
+    await store.transition(await store.get("old"), "pending", "completed")
+    await store.create(record("new", now))
+    
+    assert await store.evict_finished(now - timedelta(days=1)) == 1
+    assert await store.get("old") is None
+    assert await store.get_counts() == (1, 0)
+    
+    # 超過上限時只淘汰已結束的任務並更新統計，進行中的任務不受影響
+    await store.create(record("a", now))
+    with pytest.raises(TaskStoreFullError):
+        await store.create(record("b", now))
+    assert await store.get("new") is not None
+    assert await store.get_counts() == (2, 0)
+    
+    await store.transition(await store.get("new"), "pending", "completed")
+    await store.create(record("b", now))
+    assert await store.get("new") is None
+    assert await store.get("a") is not None
+    assert await store.get_counts() == (2, 0)
@@ -0,0 +1,43 @@
+import pytest
+
+from app.services import depthflow
+from app.services.depthflow import DepthFlowService
+
+
+class _FakeGPUManager:
+    def __init__(self, active_tasks: int, memory_percent: float = 10.0):
+        self.active_tasks = active_tasks
+        self.max_concurrent_tasks = 3
+        self.memory_percent = memory_percent
+
+    async def check_gpu_memory(self):
+        return {"available": True, "memory_percent": self.memory_percent}
+
+
+def _use_gpu_manager(monkeypatch, manager):
+    async def get_gpu_manager():
+        return manager
+
+    monkeypatch.setattr(depthflow, "get_gpu_manager", get_gpu_manager)
+
+
+@pytest.mark.asyncio
+async def test_ssaa_kept_while_other_slots_free(monkeypatch):
+    """測試呼叫端自己的槽位不計入負載：仍有其他空槽位時保留超採樣"""
+    # 呼叫端與另一個任務各佔一個槽位
+    _use_gpu_manager(monkeypatch, _FakeGPUManager(active_tasks=2))
+    service = DepthFlowService()
+
+    assert await service._effective_ssaa({"ssaa": 2.0}) == 2.0
+    assert await service._effective_ssaa({"quality": "high"}) == 1.5
+
+
+@pytest.mark.asyncio
+async def test_ssaa_dropped_under_load(monkeypatch):
+    """測試其他槽位全被佔用或記憶體吃緊時降為 1.0"""
+    _use_gpu_manager(monkeypatch, _FakeGPUManager(active_tasks=3))
+    service = DepthFlowService()
+    assert await service._effective_ssaa({"ssaa": 2.0}) == 1.0
+
+    _use_gpu_manager(monkeypatch, _FakeGPUManager(active_tasks=1, memory_percent=90.0))
+    assert await service._effective_ssaa({"ssaa": 2.0}) == 1.0
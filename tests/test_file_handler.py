@@ -0,0 +1,31 @@
+import io
+
+import pytest
+from PIL import Image
+
+from app.services.file_handler import get_file_handler
+
+
+def _image_bytes(fmt: str, size=(200, 200)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size).save(buffer, fmt)
+    return buffer.getvalue()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name, content, expected", [
+    ("valid.png", _image_bytes("PNG"), True),
+    ("valid.jpg", _image_bytes("JPEG"), True),
+    ("small.png", _image_bytes("PNG", size=(50, 50)), False),
+    ("text.png", b"This is not an image", False),
+    # 只有簽章與部分 IHDR 的截斷檔案
+    ("truncated.png", _image_bytes("PNG")[:20], False),
+    # 簽章之後不是 IHDR 區塊，檔頭中的「寬高」不可信
+    ("malformed.png", _image_bytes("PNG")[:12] + b"JUNK" + b"\x00\x00\x01\x00" * 2, False),
+])
+async def test_validate_image(tmp_path, name, content, expected):
+    """測試依檔頭驗證圖片格式與尺寸"""
+    path = tmp_path / name
+    path.write_bytes(content)
+
+    assert await get_file_handler().validate_image(str(path)) is expected
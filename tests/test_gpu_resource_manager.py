@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from app.services.gpu_resource_manager import GPUResourceManager
+
+
+async def _gpu_ready():
+    return {"can_process": True}
+
+
+async def _settle():
+    """讓已排程的協程執行到下一個等待點"""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = GPUResourceManager(max_concurrent_tasks=1)
+    monkeypatch.setattr(manager, "_check_gpu_resources", _gpu_ready)
+    return manager
+
+
+@pytest.mark.asyncio
+async def test_slot_fast_path_skips_heap(manager):
+    """測試有空槽位且無人等待時直接取得，不進入等待佇列"""
+    await manager._wait_for_slot(priority=10.0)
+    assert manager._free_slots == 0
+    assert manager._waiters == []
+
+    manager._release_slot()
+    assert manager._free_slots == 1
+
+
+@pytest.mark.asyncio
+async def test_slot_waiters_ordered_by_priority(manager):
+    """測試槽位釋出時交給排序值（進入時間 + priority）最小的等待者"""
+    order = []
+
+    async def worker(name, priority):
+        async with manager.acquire_gpu_slot(name, priority=priority):
+            order.append(name)
+
+    async with manager.acquire_gpu_slot("holder"):
+        workers = [
+            asyncio.create_task(worker("long", 100.0)),
+            asyncio.create_task(worker("short", 0.0)),
+            asyncio.create_task(worker("medium", 50.0)),
+        ]
+        await _settle()
+        assert len(manager._waiters) == 3
+
+    await asyncio.gather(*workers)
+    assert order == ["short", "medium", "long"]
+    assert manager._free_slots == 1
+    assert manager.active_tasks == 0
+
+
+@pytest.mark.asyncio
+async def test_waiter_cancelled_before_grant(manager):
+    """測試尚未分配到槽位就被取消的等待者在釋出時被略過"""
+    await manager._wait_for_slot(priority=0.0)
+    waiter = asyncio.create_task(manager._wait_for_slot(priority=0.0))
+    await _settle()
+
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    manager._release_slot()
+    assert manager._free_slots == 1
+    assert manager._waiters == []
+
+
+@pytest.mark.asyncio
+async def test_waiter_cancelled_after_grant_returns_slot(manager):
+    """測試已分配到槽位後才被取消的等待者會歸還槽位"""
+    await manager._wait_for_slot(priority=0.0)
+    waiter = asyncio.create_task(manager._wait_for_slot(priority=0.0))
+    await _settle()
+
+    # 釋出時槽位直接交給等待者，等待者恢復執行前即被取消
+    manager._release_slot()
+    assert manager._free_slots == 0
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    assert manager._free_slots == 1
+    await asyncio.wait_for(manager._wait_for_slot(priority=0.0), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_slot_released_on_error(manager):
+    """測試處理中發生錯誤時仍會釋放槽位"""
+    with pytest.raises(RuntimeError):
+        async with manager.acquire_gpu_slot("t1"):
+            assert manager.active_tasks == 1
+            raise RuntimeError("boom")
+
+    assert manager.active_tasks == 0
+    assert manager._free_slots == 1
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import threading
+
+import pytest
+
+from app.tasks import processing
+
+
+class _FailingFileHandler:
+    async def cleanup_task_files(self, task_id: str):
+        raise OSError(f"無法刪除 {task_id}")
+
+
+@pytest.mark.asyncio
+async def test_failed_cleanup_is_logged(monkeypatch, caplog):
+    """測試背景清理失敗時由 done callback 記錄錯誤並移除參照"""
+    monkeypatch.setattr(processing, "get_file_handler", lambda: _FailingFileHandler())
+
+    with caplog.at_level(logging.ERROR, logger="app.tasks.processing"):
+        processing.schedule_task_cleanup("t1")
+        await processing.wait_for_cleanup_tasks()
+        await asyncio.sleep(0)
+
+    assert "清理任務檔案失敗: 無法刪除 t1" in caplog.text
+    assert not processing._cleanup_tasks.get(asyncio.get_running_loop())
+
+
+def test_cleanup_tasks_are_per_loop(monkeypatch):
+    """測試每個事件循環只等待自己的清理工作"""
+    release = threading.Event()
+
+    class _SlowFileHandler:
+        async def cleanup_task_files(self, task_id: str):
+            await asyncio.to_thread(release.wait, 5)
+
+    monkeypatch.setattr(processing, "get_file_handler", lambda: _SlowFileHandler())
+
+    async def schedule():
+        processing.schedule_task_cleanup("other")
+
+    # 另一個循環（如其他 worker 執行緒）上留有尚未完成的清理工作
+    other_loop = asyncio.new_event_loop()
+    other_loop.run_until_complete(schedule())
+
+    async def main():
+        assert processing._cleanup_tasks.get(asyncio.get_running_loop()) is None
+        await asyncio.wait_for(processing.wait_for_cleanup_tasks(), timeout=1)
+
+    asyncio.run(main())
+
+    release.set()
+    other_loop.run_until_complete(processing.wait_for_cleanup_tasks())
+    assert not processing._cleanup_tasks.get(other_loop)
+    other_loop.close()
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from app.config import settings
+from app.tasks import webhook_batcher
+from app.tasks.webhook_batcher import WebhookBatcher
+
+
+@pytest.fixture
+def posted(monkeypatch):
+    """以記錄呼叫取代實際的 HTTP 發送"""
+    calls = []
+
+    async def fake_post_webhook(webhook_url, data):
+        calls.append((webhook_url, data))
+        return False
+
+    monkeypatch.setattr(webhook_batcher, "post_webhook", fake_post_webhook)
+    monkeypatch.setattr(settings, "webhook_batch_enabled", True)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_batches_within_window(posted):
+    """測試時間窗內的通知合併送出，時間窗之後的通知另成一批"""
+    batcher = WebhookBatcher(window=0.05)
+    await batcher.enqueue("http://a", {"n": 1})
+    await batcher.enqueue("http://a", {"n": 2})
+    await asyncio.sleep(0.15)
+    assert posted == [("http://a", [{"n": 1}, {"n": 2}])]
+
+    await batcher.enqueue("http://a", {"n": 3})
+    await batcher.close()
+    assert posted[1:] == [("http://a", {"n": 3})]
+
+
+@pytest.mark.asyncio
+async def test_max_batch_cutoff(posted):
+    """測試達到 max_batch 時不等時間窗結束即送出"""
+    batcher = WebhookBatcher(window=10, max_batch=2)
+    for n in range(3):
+        await batcher.enqueue("http://a", {"n": n})
+    await asyncio.sleep(0.05)
+    assert posted == [("http://a", [{"n": 0}, {"n": 1}])]
+
+    await batcher.close()
+    assert posted[1:] == [("http://a", {"n": 2})]
+
+
+@pytest.mark.asyncio
+async def test_groups_by_url(posted):
+    """測試同一批內依 URL 分組"""
+    batcher = WebhookBatcher()
+    await batcher.enqueue("http://a", {"n": 1})
+    await batcher.enqueue("http://b", {"n": 2})
+    await batcher.enqueue("http://a", {"n": 3})
+    await batcher.close()
+
+    assert sorted(posted, key=lambda call: call[0]) == [
+        ("http://a", [{"n": 1}, {"n": 3}]),
+        ("http://b", {"n": 2}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_batching_disabled_sends_individually(posted, monkeypatch):
+    """測試未啟用批次模式時逐一送出單一通知"""
+    monkeypatch.setattr(settings, "webhook_batch_enabled", False)
+    batcher = WebhookBatcher()
+    await batcher.enqueue("http://a", {"n": 1})
+    await batcher.enqueue("http://a", {"n": 2})
+    await batcher.close()
+
+    assert posted == [("http://a", {"n": 1}), ("http://a", {"n": 2})]
+
+
+@pytest.mark.asyncio
+async def test_close_drains_queue(posted):
+    """測試關閉時立即送出佇列中剩餘的通知，不等待時間窗"""
+    batcher = WebhookBatcher(window=10)
+    await batcher.enqueue("http://a", {"n": 1})
+    await batcher.enqueue("http://b", {"n": 2})
+
+    await asyncio.wait_for(batcher.close(), timeout=1)
+    assert sorted(posted, key=lambda call: call[0]) == [
+        ("http://a", {"n": 1}),
+        ("http://b", {"n": 2}),
+    ]